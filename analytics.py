@@ -0,0 +1,308 @@
+from datetime import datetime
+from typing import Dict, List, Sequence
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import func, select
+
+import db
+from logger import logger
+from models import LapRecord, LapRecordHistory, Subscription, Vehicle
+
+GROUPS = ("subscription", "track", "class", "track_class")
+
+
+class LeaderboardEngine(object):
+    """
+    Read-side copy of lap_records in NumPy columns for analytics
+
+    Rows are kept sorted by subscription and lap time, so a leaderboard is
+    a contiguous slice and a rank is a binary search. Players are integer
+    encoded, lap times are int32. refresh() applies records observed in
+    lap_record_history since the last load instead of reloading everything.
+    """
+
+    def __init__(self):
+        self.subscriptions = np.empty(0, dtype=np.int32)
+        self.players = np.empty(0, dtype=np.int32)
+        self.lap_times = np.empty(0, dtype=np.int32)
+        self._keys = np.empty(0, dtype=np.int64)
+        self._starts = np.zeros(1, dtype=np.int64)
+        self._player_codes: Dict[str, int] = dict()
+        self._player_ids: List[str] = []
+        self.watermark: datetime = None
+        self.track_ids: List[int] = []
+        self.class_ids: List[str] = []
+        self.subscription_track = np.empty(0, dtype=np.int64)
+        self.subscription_vehicle = np.empty(0, dtype=np.int64)
+        self.subscription_track_code = np.empty(0, dtype=np.int32)
+        self.subscription_class_code = np.empty(0, dtype=np.int32)
+
+    def __len__(self):
+        return len(self.lap_times)
+
+    def _encode_player(self, player_id: str) -> int:
+        code = self._player_codes.get(player_id)
+        if code is None:
+            code = len(self._player_ids)
+            self._player_codes[player_id] = code
+            self._player_ids.append(player_id)
+        return code
+
+    def _load_subscriptions(self):
+        rows = db.session.execute(
+            select(
+                Subscription.id,
+                Subscription.track_id,
+                Subscription.vehicle_id,
+                Vehicle.class_id,
+            ).join(Vehicle)
+        ).all()
+        size = max(id_ for id_, *_ in rows) + 1 if rows else 1
+        self.class_ids = sorted({class_id or "" for *_, class_id in rows})
+        class_codes = {class_id: i for i, class_id in enumerate(self.class_ids)}
+        self.track_ids = sorted({track_id for _, track_id, _, _ in rows})
+        track_codes = {track_id: i for i, track_id in enumerate(self.track_ids)}
+        # per subscription id lookups
+        self.subscription_track = np.zeros(size, dtype=np.int64)
+        self.subscription_vehicle = np.zeros(size, dtype=np.int64)
+        self.subscription_track_code = np.zeros(size, dtype=np.int32)
+        self.subscription_class_code = np.zeros(size, dtype=np.int32)
+        for id_, track_id, vehicle_id, class_id in rows:
+            self.subscription_track[id_] = track_id
+            self.subscription_vehicle[id_] = vehicle_id
+            self.subscription_track_code[id_] = track_codes[track_id]
+            self.subscription_class_code[id_] = class_codes[class_id or ""]
+
+    def _index(self):
+        """
+        Sorts rows by subscription and lap time and finds leaderboard slices
+        """
+        keys = (self.subscriptions.astype(np.int64) << 32) | self.lap_times
+        order = np.argsort(keys, kind="stable")
+        self._keys = keys[order]
+        self.subscriptions = self.subscriptions[order]
+        self.players = self.players[order]
+        self.lap_times = self.lap_times[order]
+        self._find_starts()
+
+    def _find_starts(self):
+        # rows of subscription s are _starts[s]:_starts[s + 1]
+        self._starts = np.searchsorted(
+            self.subscriptions, np.arange(len(self.subscription_track) + 1)
+        )
+
+    def load(self):
+        """
+        Loads all lap records, replacing what was loaded before
+        """
+        # taken first, records changing during the load are applied again
+        self.watermark = db.session.query(
+            func.max(LapRecordHistory.observed_at)
+        ).scalar()
+        self._load_subscriptions()
+        statement = select(
+            LapRecord.subscription_id, LapRecord.player_id, LapRecord.lap_time
+        ).compile(db.engine)
+        # a DBAPI cursor skips building a result row object per record
+        cursor = db.session.connection().connection.cursor()
+        try:
+            cursor.execute(str(statement), statement.params)
+            rows = cursor.fetchall()
+        finally:
+            cursor.close()
+        frame = pd.DataFrame.from_records(
+            rows, columns=["subscription_id", "player_id", "lap_time"]
+        )
+        # encoding players in bulk, a dict lookup per row is the slowest step
+        codes, player_ids = pd.factorize(frame["player_id"])
+        self._player_ids = list(player_ids)
+        self._player_codes = {
+            player_id: code for code, player_id in enumerate(self._player_ids)
+        }
+        self.subscriptions = frame["subscription_id"].to_numpy(dtype=np.int32)
+        self.players = codes.astype(np.int32)
+        self.lap_times = frame["lap_time"].to_numpy(dtype=np.int32)
+        self._index()
+        logger.info(f"Loaded {len(rows)} lap records into the analytics engine")
+        return self
+
+    def refresh(self) -> int:
+        """
+        Applies new and improved records observed since the last load or
+        refresh; removed lap records need a full load()
+
+        Returns:
+        int: number of changed rows
+        """
+        if self.watermark is None:
+            self.load()
+            return len(self)
+        rows = (
+            db.session.query(
+                LapRecordHistory.subscription_id,
+                LapRecordHistory.player_id,
+                LapRecordHistory.lap_time,
+                LapRecordHistory.observed_at,
+            )
+            .filter(LapRecordHistory.observed_at >= self.watermark)
+            .all()
+        )
+        if not rows:
+            return 0
+        self.watermark = max(row[3] for row in rows)
+        if max(row[0] for row in rows) >= len(self.subscription_track):
+            self._load_subscriptions()
+            self._find_starts()
+
+        best = dict()
+        for subscription_id, player_id, lap_time, _ in rows:
+            key = (subscription_id, player_id)
+            if key not in best or lap_time < best[key]:
+                best[key] = lap_time
+        removed = []
+        added = []
+        for (subscription_id, player_id), lap_time in best.items():
+            code = self._encode_player(player_id)
+            start, end = self._starts[subscription_id : subscription_id + 2]
+            found = np.flatnonzero(self.players[start:end] == code)
+            if found.size:
+                if self.lap_times[start + found[0]] <= lap_time:
+                    continue
+                removed.append(start + found[0])
+            added.append((subscription_id, code, lap_time))
+        if not added:
+            return 0
+
+        columns = [
+            np.delete(column, removed)
+            for column in (
+                self._keys,
+                self.subscriptions,
+                self.players,
+                self.lap_times,
+            )
+        ]
+        added = np.array(added, dtype=np.int64)
+        added_keys = (added[:, 0] << 32) | added[:, 2]
+        order = np.argsort(added_keys)
+        positions = np.searchsorted(columns[0], added_keys[order])
+        self._keys = np.insert(columns[0], positions, added_keys[order])
+        self.subscriptions = np.insert(columns[1], positions, added[order, 0])
+        self.players = np.insert(columns[2], positions, added[order, 1])
+        self.lap_times = np.insert(columns[3], positions, added[order, 2])
+        self._find_starts()
+        return len(added)
+
+    def _ranks(self, rows: np.ndarray) -> tuple:
+        """
+        Returns number of faster records and records on the leaderboard of
+        each row; equal lap times share a rank
+        """
+        subscriptions = self.subscriptions[rows]
+        starts = self._starts[subscriptions]
+        faster = np.searchsorted(self._keys, self._keys[rows]) - starts
+        entries = self._starts[subscriptions + 1] - starts
+        return faster, entries
+
+    def _frame(self, rows: np.ndarray) -> pd.DataFrame:
+        faster, entries = self._ranks(rows)
+        subscriptions = self.subscriptions[rows]
+        leader_times = self.lap_times[self._starts[subscriptions]]
+        return pd.DataFrame(
+            {
+                "subscription_id": subscriptions,
+                "track_id": self.subscription_track[subscriptions],
+                "vehicle_id": self.subscription_vehicle[subscriptions],
+                "class_id": np.array(self.class_ids, dtype=object)[
+                    self.subscription_class_code[subscriptions]
+                ],
+                "lap_time": self.lap_times[rows],
+                "gap": self.lap_times[rows] - leader_times,
+                "position": faster + 1,
+                "entries": entries,
+                # share of the leaderboard at least as slow, 100 for the leader
+                "percentile": 100.0 * (entries - faster) / entries,
+            }
+        )
+
+    def player_percentiles(self, player_id: str) -> pd.DataFrame:
+        """
+        Returns position, gap to the leader and percentile of a player on
+        every leaderboard with a record of theirs
+        """
+        code = self._player_codes.get(player_id)
+        if code is None:
+            return self._frame(np.empty(0, dtype=np.int64))
+        return self._frame(np.flatnonzero(self.players == code))
+
+    def gaps_to_leader(self) -> np.ndarray:
+        """
+        Returns the gap of every row to the fastest lap of its leaderboard
+        """
+        return self.lap_times - self.lap_times[self._starts[self.subscriptions]]
+
+    def _group_codes(self, by: str) -> tuple:
+        if by == "subscription":
+            return self.subscriptions.astype(np.int64), None
+        track_codes = self.subscription_track_code[self.subscriptions]
+        class_codes = self.subscription_class_code[self.subscriptions]
+        if by == "track":
+            return track_codes.astype(np.int64), None
+        if by == "class":
+            return class_codes.astype(np.int64), None
+        if by == "track_class":
+            codes = track_codes.astype(np.int64) * len(self.class_ids) + class_codes
+            return codes, len(self.class_ids)
+        raise ValueError(f"unknown group '{by}', expected one of {GROUPS}")
+
+    def group_percentiles(
+        self, by: str = "track_class", q: Sequence[float] = (10, 50, 90)
+    ) -> pd.DataFrame:
+        """
+        Returns lap time percentiles (nearest rank) of every group
+        """
+        codes, classes = self._group_codes(by)
+        order = np.argsort((codes << 32) | self.lap_times)
+        codes = codes[order]
+        lap_times = self.lap_times[order]
+        groups, starts, entries = np.unique(
+            codes, return_index=True, return_counts=True
+        )
+        frame = {"entries": entries}
+        if by == "subscription":
+            frame["subscription_id"] = groups
+        if by in ("track", "track_class"):
+            track_codes = groups // classes if classes else groups
+            frame["track_id"] = np.array(self.track_ids)[track_codes]
+        if by in ("class", "track_class"):
+            class_codes = groups % classes if classes else groups
+            frame["class_id"] = np.array(self.class_ids, dtype=object)[class_codes]
+        for percentile in q:
+            offsets = np.floor(percentile / 100 * (entries - 1)).astype(np.int64)
+            frame[f"p{percentile:g}"] = lap_times[starts + offsets]
+        return pd.DataFrame(frame)
+
+    def player_rankings(
+        self, min_leaderboards: int = 5, top: int = 100
+    ) -> pd.DataFrame:
+        """
+        Ranks players on all vehicles by their mean percentile over the
+        leaderboards they have records on
+        """
+        faster, entries = self._ranks(np.arange(len(self)))
+        percentiles = 100.0 * (entries - faster) / entries
+        counts = np.bincount(self.players, minlength=len(self._player_ids))
+        sums = np.bincount(
+            self.players, weights=percentiles, minlength=len(self._player_ids)
+        )
+        eligible = np.flatnonzero(counts >= min_leaderboards)
+        means = sums[eligible] / counts[eligible]
+        best = eligible[np.argsort(-means, kind="stable")[:top]]
+        return pd.DataFrame(
+            {
+                "player_id": np.array(self._player_ids, dtype=object)[best],
+                "leaderboards": counts[best],
+                "mean_percentile": sums[best] / counts[best],
+            }
+        )
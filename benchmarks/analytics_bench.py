@@ -0,0 +1,116 @@
+"""
+Benchmarks analytics.LeaderboardEngine against the equivalent SQL
+
+Run from the repository root against a scratch database filled by
+benchmarks.views_bench, e.g.:
+    DB_CONNECT_STR=sqlite:///bench.sqlite python -m benchmarks.analytics_bench
+"""
+import argparse
+import random
+from datetime import datetime
+from time import perf_counter
+
+from sqlalchemy import func
+
+import db
+from analytics import LeaderboardEngine
+from models import LapRecord
+from page_parse import LapRecordTuple
+
+
+def sql_player_positions(player_id: str) -> dict:
+    """
+    Positions of a player on every leaderboard, one SQL count per record
+    """
+    positions = dict()
+    for subscription_id, lap_time in db.session.query(
+        LapRecord.subscription_id, LapRecord.lap_time
+    ).filter(LapRecord.player_id == player_id):
+        faster = (
+            db.session.query(func.count())
+            .select_from(LapRecord)
+            .filter(LapRecord.subscription_id == subscription_id)
+            .filter(LapRecord.lap_time < lap_time)
+            .scalar()
+        )
+        positions[subscription_id] = faster + 1
+    return positions
+
+
+def _rows(engine: LeaderboardEngine) -> list:
+    player_ids = [engine._player_ids[code] for code in engine.players]
+    return sorted(
+        zip(engine.subscriptions.tolist(), player_ids, engine.lap_times.tolist())
+    )
+
+
+def improve_records(count: int, seed: int = 0):
+    """
+    Improves random lap records through Subscription.update, which writes
+    the lap record history the engine refreshes from
+    """
+    rnd = random.Random(seed)
+    records = db.session.query(LapRecord).order_by(func.random()).limit(count).all()
+    for record in records:
+        record.subscription.update(
+            [
+                LapRecordTuple(
+                    record.player_id,
+                    record.player_name,
+                    record.lap_time - rnd.randint(1, 5000),
+                    record.sector1,
+                    record.sector2,
+                    record.sector3,
+                    record.controller_id,
+                    datetime.utcnow().replace(second=0, microsecond=0),
+                )
+            ]
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--players", type=int, default=20)
+    parser.add_argument("--improve", type=int, default=200)
+    args = parser.parse_args()
+
+    start = perf_counter()
+    engine = LeaderboardEngine().load()
+    print(f"load: {perf_counter() - start:.2f} s ({len(engine)} rows)")
+
+    player_ids = random.Random(0).sample(
+        [p for p, in db.session.query(LapRecord.player_id).distinct().limit(10000)],
+        args.players,
+    )
+    timings = []
+    sql_timings = []
+    for player_id in player_ids:
+        start = perf_counter()
+        frame = engine.player_percentiles(player_id)
+        timings.append(perf_counter() - start)
+        start = perf_counter()
+        expected = sql_player_positions(player_id)
+        sql_timings.append(perf_counter() - start)
+        if dict(zip(frame["subscription_id"], frame["position"])) != expected:
+            raise AssertionError(f"positions of {player_id} differ from SQL")
+    print(
+        f"player percentiles: {1000 * sum(timings) / len(timings):.2f} ms per "
+        f"player, SQL: {1000 * sum(sql_timings) / len(sql_timings):.2f} ms"
+    )
+
+    for name, function in (
+        ("track/class percentiles", lambda: engine.group_percentiles("track_class")),
+        ("player rankings", lambda: engine.player_rankings()),
+        ("gaps to leader", engine.gaps_to_leader),
+    ):
+        start = perf_counter()
+        function()
+        print(f"{name}: {1000 * (perf_counter() - start):.1f} ms")
+
+    improve_records(args.improve)
+    start = perf_counter()
+    changed = engine.refresh()
+    print(f"refresh: {1000 * (perf_counter() - start):.1f} ms ({changed} rows)")
+    if _rows(engine) != _rows(LeaderboardEngine().load()):
+        raise AssertionError("refreshed engine differs from a full load")
+    print("refreshed engine matches a full load")
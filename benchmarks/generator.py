@@ -0,0 +1,247 @@
+"""
+Generates synthetic leaderboards shaped like the wmdportal pages
+
+Every leaderboard is derived from its own seed, so a page renders the same
+on every request and the records a parser should find are known upfront.
+"""
+import random
+from datetime import datetime, timedelta
+from html import escape
+from typing import Dict, List, Tuple
+
+from page_parse import LapRecordTuple
+from static_data_api import get_tracks, get_vehicle_classes, get_vehicles
+
+ROWS_PER_PAGE = 100
+EPOCH = datetime(2017, 9, 22)
+# share of rows without a public profile, which parsers skip
+UNKNOWN_PLAYER_RATE = 0.02
+
+
+def _format_lap_time(millis: int) -> str:
+    seconds, millis = divmod(millis, 1000)
+    minutes, seconds = divmod(seconds, 60)
+    return f"{minutes}:{seconds:02d}.{millis:03d}"
+
+
+def get_subscriptions(limit: int = None) -> List[Tuple[int, int]]:
+    """
+    Returns (track_id, vehicle_id) pairs of the active subscriptions
+    rebuild_db.py creates from static_data
+    """
+    vehicle_classes = get_vehicle_classes()
+    ignored_classes = vehicle_classes.loc[vehicle_classes["ignored"] == True, "id"]
+    tracks = get_tracks()
+    vehicles = get_vehicles()
+    track_ids = tracks.loc[tracks["ignored"] == False, "id"]
+    vehicle_ids = vehicles.loc[
+        (vehicles["ignored"] == False) & ~vehicles["class_id"].isin(ignored_classes),
+        "id",
+    ]
+    subscriptions = [
+        (int(track_id), int(vehicle_id))
+        for track_id in track_ids
+        for vehicle_id in vehicle_ids
+    ]
+    return subscriptions[:limit] if limit else subscriptions
+
+
+class LeaderboardGenerator(object):
+    """
+    Deterministic leaderboards of records_per_leaderboard rows drawn from a
+    pool of players
+    """
+
+    def __init__(
+        self,
+        players: int = 20000,
+        records_per_leaderboard: int = 300,
+        rows_per_page: int = ROWS_PER_PAGE,
+        seed: int = 0,
+    ):
+        self.players = players
+        self.records_per_leaderboard = records_per_leaderboard
+        self.rows_per_page = rows_per_page
+        self.seed = seed
+        self._leaderboards = dict()
+
+    @staticmethod
+    def steam_id(player: int) -> str:
+        return f"7656119{player:010d}"
+
+    def _random(self, *key) -> random.Random:
+        return random.Random(":".join(map(str, (self.seed,) + key)))
+
+    def leaderboard(self, track_id: int, vehicle_id: int) -> List[LapRecordTuple]:
+        """
+        Returns all rows of a leaderboard ordered by lap time, including
+        rows of players named <unknown>
+        """
+        key = (track_id, vehicle_id)
+        if key not in self._leaderboards:
+            rnd = self._random(track_id, vehicle_id)
+            base_time = rnd.randint(60000, 300000)
+            rows = []
+            for player in rnd.sample(
+                range(self.players), min(self.players, self.records_per_leaderboard)
+            ):
+                lap_time = base_time + int(rnd.expovariate(1 / 4000))
+                sector = lap_time // 3
+                if rnd.random() < UNKNOWN_PLAYER_RATE:
+                    name = "<unknown>"
+                else:
+                    name = rnd.choice(("", "[", "<", "&")) + f"player {player}"
+                rows.append(
+                    LapRecordTuple(
+                        self.steam_id(player),
+                        name,
+                        lap_time,
+                        sector,
+                        sector,
+                        lap_time - 2 * sector,
+                        rnd.choice("WG"),
+                        EPOCH + timedelta(minutes=rnd.randrange(2 ** 21)),
+                    )
+                )
+            rows.sort(key=lambda row: (row.lap_time, row.upload_date))
+            self._leaderboards[key] = rows
+        return self._leaderboards[key]
+
+    def lap_records(self, track_id: int, vehicle_id: int) -> List[LapRecordTuple]:
+        """
+        Returns the records a parser should find over all pages
+        """
+        return [
+            row
+            for row in self.leaderboard(track_id, vehicle_id)
+            if row.player_name != "<unknown>"
+        ]
+
+    def number_of_pages(self, track_id: int, vehicle_id: int) -> int:
+        rows = len(self.leaderboard(track_id, vehicle_id))
+        return -(-rows // self.rows_per_page)
+
+    def render_page(
+        self, track_id: int, vehicle_id: int, page: int = 1, by_date: bool = False
+    ) -> str:
+        """
+        Renders a leaderboard page, newest records first if by_date
+        """
+        rows = self.leaderboard(track_id, vehicle_id)
+        if by_date:
+            rows = sorted(rows, key=lambda row: row.upload_date, reverse=True)
+        number_of_pages = self.number_of_pages(track_id, vehicle_id)
+        first = (page - 1) * self.rows_per_page
+        return render_page(
+            rows[first : first + self.rows_per_page], first + 1, number_of_pages
+        )
+
+    def improved(
+        self, track_id: int, vehicle_id: int, fraction: float = 0.1
+    ) -> List[LapRecordTuple]:
+        """
+        Returns the parsed records with a fraction of them improved and
+        uploaded a day after the newest record
+        """
+        rnd = self._random(track_id, vehicle_id, "improved")
+        records = self.lap_records(track_id, vehicle_id)
+        upload_date = max(record.upload_date for record in records)
+        upload_date += timedelta(days=1)
+        improved = []
+        for record in records:
+            if rnd.random() < fraction:
+                lap_time = record.lap_time - rnd.randint(1, 1000)
+                sector = lap_time // 3
+                record = record._replace(
+                    lap_time=lap_time,
+                    sector1=sector,
+                    sector2=sector,
+                    sector3=lap_time - 2 * sector,
+                    upload_date=upload_date,
+                )
+            improved.append(record)
+        return improved
+
+
+def _render_row(rank: int, record: LapRecordTuple) -> str:
+    controller = "Wheel" if record.controller_id == "W" else "Gamepad"
+    sectors = "&#10;".join(
+        f"Sector {i}: {_format_lap_time(sector)}"
+        for i, sector in enumerate(
+            (record.sector1, record.sector2, record.sector3), start=1
+        )
+    )
+    return (
+        f'<tr class="{"odd" if rank % 2 else "even"}">\n'
+        f'<td class="rank">{rank}</td>\n'
+        f'<td class="user" id="user-{record.player_id}">'
+        f'<a href="/profile/{record.player_id}">{escape(record.player_name)}</a>'
+        "</td>\n"
+        f'<td class="time" title="{sectors}">'
+        f'<span class="time">{_format_lap_time(record.lap_time)}</span>'
+        '<span class="gap"></span></td>\n'
+        '<td class="assists"><img src="/img/assists.png" title="Assists: none"/>'
+        f'<img src="/img/{controller.lower()}.png" title="Controller: {controller}"/>'
+        "</td>\n"
+        f'<td class="timestamp">{record.upload_date:%d/%m/%Y %H:%M}</td>\n'
+        "</tr>"
+    )
+
+
+def render_page(
+    records: List[LapRecordTuple], first_rank: int, number_of_pages: int
+) -> str:
+    """
+    Renders a leaderboard page holding records ranked from first_rank
+    """
+    if records:
+        body = "\n".join(
+            _render_row(rank, record)
+            for rank, record in enumerate(records, start=first_rank)
+        )
+    else:
+        body = '<tr class="no_data"><td colspan="5">No data</td></tr>'
+    pager = ""
+    if number_of_pages > 1:
+        options = "".join(
+            f'<option value="{page}">{page}</option>'
+            for page in range(1, number_of_pages + 1)
+        )
+        pager = f'<select id="pager_top_select_page">{options}</select>'
+    return (
+        "<html><head><title>Leaderboard</title></head><body>\n"
+        f'<div class="pager">{pager}</div>\n'
+        '<table id="leaderboard">\n'
+        "<thead><tr><th>Rank</th><th>User</th><th>Time</th><th>Assists</th>"
+        "<th>Date</th></tr></thead>\n"
+        '<tbody class="you"></tbody>\n'
+        f"<tbody>\n{body}\n</tbody>\n"
+        "</table>\n</body></html>"
+    )
+
+
+def render_error_page() -> str:
+    """
+    Renders the page served for an invalid track and vehicle combination
+    """
+    return (
+        "<html><body>\n"
+        '<p class="msg error">Invalid track or vehicle selected</p>\n'
+        "</body></html>"
+    )
+
+
+def generate_pages(generator: LeaderboardGenerator, pages: int) -> Dict[tuple, str]:
+    """
+    Renders the first pages of as many subscriptions as needed, keyed by
+    (track_id, vehicle_id, page)
+    """
+    rendered = dict()
+    for track_id, vehicle_id in get_subscriptions():
+        for page in range(1, generator.number_of_pages(track_id, vehicle_id) + 1):
+            if len(rendered) == pages:
+                return rendered
+            rendered[(track_id, vehicle_id, page)] = generator.render_page(
+                track_id, vehicle_id, page
+            )
+    return rendered
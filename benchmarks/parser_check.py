@@ -0,0 +1,56 @@
+"""
+Checks the parser backends against saved leaderboard pages
+
+expected.json holds what the original BeautifulSoup parser returned for
+every page in benchmarks/fixtures, including rows of unknown and private
+players that lack the other cells, e.g.:
+    python -m benchmarks.parser_check
+"""
+import json
+import os
+from datetime import datetime
+from typing import Dict, Tuple
+
+from page_parse import PARSERS, LapRecordTuple, PageTuple
+
+FIXTURES_PATH = os.path.join(os.path.dirname(__file__), "fixtures")
+
+
+def load_fixtures() -> Dict[str, Tuple[str, PageTuple]]:
+    """
+    Returns (page content, expected PageTuple) by fixture name
+    """
+    with open(os.path.join(FIXTURES_PATH, "expected.json")) as f:
+        expected = json.load(f)
+    fixtures = dict()
+    for name, page in expected.items():
+        with open(os.path.join(FIXTURES_PATH, f"{name}.html")) as f:
+            content = f.read()
+        lap_records = [
+            LapRecordTuple(*record[:-1], datetime.fromisoformat(record[-1]))
+            for record in page["lap_records"]
+        ]
+        fixtures[name] = (
+            content,
+            PageTuple(page["is_valid"], page["number_of_pages"], lap_records),
+        )
+    return fixtures
+
+
+def check(parsers: dict = PARSERS):
+    """
+    Raises AssertionError naming every fixture a backend parses differently
+    """
+    mismatches = [
+        f"{backend} on {name}"
+        for name, (content, expected) in load_fixtures().items()
+        for backend, parse in parsers.items()
+        if parse(content) != expected
+    ]
+    if mismatches:
+        raise AssertionError(f"parsers differ from the original: {mismatches}")
+
+
+if __name__ == "__main__":
+    check()
+    print(f"{len(PARSERS)} backends match {len(load_fixtures())} fixtures")
@@ -0,0 +1,280 @@
+"""
+End-to-end benchmark suite on generated data and a local leaderboard server
+
+Always runs against a scratch SQLite database, never the configured one.
+Results are compared with benchmarks/baselines.json taken at the same scale:
+    python -m benchmarks.run                   # compare with the baselines
+    python -m benchmarks.run --save            # store results as baselines
+    python -m benchmarks.run --only parse scrape
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import sys
+import tempfile
+from time import perf_counter
+
+from benchmarks.server import URL_TEMPLATE
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+SCRATCH_DB = os.path.join(tempfile.gettempdir(), "leaderboard_benchmark.sqlite")
+PORT = _free_port()
+
+# settings are read on import, so they are pointed at the scratch database
+# and the local server before any module using them is imported
+os.environ.update(
+    DB_CONNECT_STR=f"sqlite:///{SCRATCH_DB}",
+    DATASOURCE_URL=URL_TEMPLATE.format(host="127.0.0.1", port=PORT),
+    DATASOURCE_URL_BY_DATE="",
+    PAGE_CACHE_PATH="",
+    DISCORD_WEBHOOK="",
+)
+for name, value in (
+    ("LOW_UPDATE_THRESHOLD", "50"),
+    ("LOW_UPDATE_INTERVAL", "96"),
+    ("MID_UPDATE_INTERVAL", "48"),
+    ("HIGH_UPDATE_INTERVAL", "6"),
+):
+    os.environ.setdefault(name, value)
+
+import bs4  # noqa: E402
+import sqlalchemy  # noqa: E402
+
+import db  # noqa: E402
+import views  # noqa: E402
+from benchmarks import parser_check  # noqa: E402
+from benchmarks.generator import (  # noqa: E402
+    LeaderboardGenerator,
+    generate_pages,
+    get_subscriptions,
+)
+from benchmarks.server import LeaderboardServer  # noqa: E402
+from benchmarks.views_bench import fill_lap_records  # noqa: E402
+from crawler import CrawlScheduler, create_http_session  # noqa: E402
+from models import (  # noqa: E402
+    LapRecord,
+    LapRecordHistory,
+    Player,
+    Subscription,
+    SubscriptionBest,
+    TrackClassBest,
+)
+from page_cache import clear_page_cache  # noqa: E402
+from page_parse import _scrape_soup, parse_page_bs4, parse_page_fast  # noqa: E402
+from rebuild_db import populate_tables, recreate_tables  # noqa: E402
+from scrape import scrape_lap_records  # noqa: E402
+
+BASELINES_PATH = os.path.join(os.path.dirname(__file__), "baselines.json")
+SUITES = ("parse", "scrape", "populate", "update", "views")
+
+
+def best_of(function, repeat: int) -> float:
+    timings = []
+    for _ in range(repeat):
+        start = perf_counter()
+        function()
+        timings.append(perf_counter() - start)
+    return min(timings)
+
+
+def _clear_lap_records():
+    for class_ in (
+        LapRecord,
+        LapRecordHistory,
+        SubscriptionBest,
+        TrackClassBest,
+        Player,
+    ):
+        db.session.query(class_).delete()
+    db.session.commit()
+    clear_page_cache()
+
+
+def _get_subscriptions(limit: int):
+    fresh = not sqlalchemy.inspect(db.engine).has_table("subscriptions")
+    if fresh or not db.session.query(Subscription).first():
+        recreate_tables()
+        populate_tables()
+    subscriptions = {
+        (s.track_id, s.vehicle_id): s for s in db.session.query(Subscription)
+    }
+    return [subscriptions[key] for key in get_subscriptions(limit)]
+
+
+def bench_parse(generator: LeaderboardGenerator, args) -> dict:
+    pages = list(generate_pages(generator, args.pages).values())
+    soups = [bs4.BeautifulSoup(page, "html.parser") for page in pages]
+    parser_check.check()
+    if [parse_page_fast(page) for page in pages] != [
+        parse_page_bs4(page) for page in pages
+    ]:
+        raise AssertionError("parser backends disagree on generated pages")
+    per_page = 1000 / len(pages)
+    return {
+        "_scrape_soup ms/page": per_page
+        * best_of(lambda: [_scrape_soup(soup) for soup in soups], args.repeat),
+        "parse_page_bs4 ms/page": per_page
+        * best_of(lambda: [parse_page_bs4(page) for page in pages], args.repeat),
+        "parse_page_fast ms/page": per_page
+        * best_of(lambda: [parse_page_fast(page) for page in pages], args.repeat),
+    }
+
+
+async def _scrape(generator: LeaderboardGenerator, args) -> dict:
+    subscriptions = get_subscriptions(args.subscriptions)
+    server = LeaderboardServer(generator, args.latency)
+    await server.start(port=PORT)
+    timings = []
+    try:
+        for _ in range(args.repeat):
+            server.requests = 0
+            scheduler = CrawlScheduler(requests_per_second=1e6, burst=1000)
+            async with create_http_session() as http_session:
+                start = perf_counter()
+                results = await asyncio.gather(
+                    *(
+                        scrape_lap_records(
+                            http_session, track_id, vehicle_id, scheduler
+                        )
+                        for track_id, vehicle_id in subscriptions
+                    )
+                )
+                timings.append((perf_counter() - start) / server.requests)
+    finally:
+        await server.stop()
+    for (track_id, vehicle_id), records in zip(subscriptions, results):
+        if sorted(records) != sorted(generator.lap_records(track_id, vehicle_id)):
+            raise AssertionError(f"wrong records for {track_id}/{vehicle_id}")
+    return {"scrape_lap_records ms/page": 1000 * min(timings)}
+
+
+def bench_scrape(generator: LeaderboardGenerator, args) -> dict:
+    return asyncio.run(_scrape(generator, args))
+
+
+def bench_populate(generator: LeaderboardGenerator, args) -> dict:
+    def _populate():
+        recreate_tables()
+        populate_tables()
+
+    return {"populate_tables s": best_of(_populate, args.repeat)}
+
+
+def bench_update(generator: LeaderboardGenerator, args) -> dict:
+    subscriptions = _get_subscriptions(args.subscriptions)
+    _clear_lap_records()
+    results = dict()
+    for name, get_records in (
+        ("new", generator.lap_records),
+        ("improved", generator.improved),
+    ):
+        records = [get_records(s.track_id, s.vehicle_id) for s in subscriptions]
+        start = perf_counter()
+        for subscription, lap_records in zip(subscriptions, records):
+            subscription.update(lap_records)
+        seconds = perf_counter() - start
+        results[f"Subscription.update {name} ms/subscription"] = (
+            1000 * seconds / len(subscriptions)
+        )
+    return results
+
+
+def bench_views(generator: LeaderboardGenerator, args) -> dict:
+    _get_subscriptions(None)
+    _clear_lap_records()
+    fill_lap_records(args.view_rows, generator.players, args.tracked)
+    functions = {
+        "get_top_tracked_per_track_and_class": (
+            views.get_top_tracked_per_track_and_class
+        ),
+        "get_top_records vehicle n=3": lambda: views.get_top_records(
+            ("vehicle",), n=3, tracked_only=False
+        ),
+        "get_all_tracked_records": views.get_all_tracked_records,
+    }
+    return {
+        f"{name} ms": 1000 * best_of(function, args.repeat)
+        for name, function in functions.items()
+    }
+
+
+def compare(results: dict, baselines: dict, tolerance: float) -> bool:
+    """
+    Prints results next to their baselines, returns False on regressions
+    """
+    passed = True
+    for name, value in results.items():
+        baseline = baselines.get(name)
+        if baseline is None:
+            print(f"{name:<48} {value:>10.3f}")
+            continue
+        ratio = value / baseline if baseline else float("inf")
+        flag = ""
+        if ratio > 1 + tolerance:
+            flag = "  REGRESSION"
+            passed = False
+        print(f"{name:<48} {value:>10.3f} {baseline:>10.3f} {ratio:>6.2f}x{flag}")
+    return passed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--only", nargs="+", choices=SUITES, default=SUITES)
+    parser.add_argument("--players", type=int, default=20000)
+    parser.add_argument("--records", type=int, default=300)
+    parser.add_argument("--pages", type=int, default=50)
+    parser.add_argument("--subscriptions", type=int, default=200)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--view-rows", type=int, default=200000)
+    parser.add_argument("--tracked", type=int, default=50)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    parser.add_argument("--baselines", default=BASELINES_PATH)
+    parser.add_argument("--save", action="store_true")
+    args = parser.parse_args()
+
+    params = {
+        name: getattr(args, name)
+        for name in (
+            "players",
+            "records",
+            "pages",
+            "subscriptions",
+            "latency",
+            "view_rows",
+            "tracked",
+        )
+    }
+    generator = LeaderboardGenerator(args.players, args.records)
+    results = dict()
+    for suite in SUITES:
+        if suite in args.only:
+            results.update(globals()[f"bench_{suite}"](generator, args))
+
+    stored = {"params": params, "results": dict()}
+    if os.path.exists(args.baselines):
+        with open(args.baselines) as f:
+            stored = json.load(f)
+    if args.save:
+        if stored["params"] != params:
+            stored = {"params": params, "results": dict()}
+        stored["results"].update(
+            {name: round(value, 3) for name, value in results.items()}
+        )
+        with open(args.baselines, "w") as f:
+            json.dump(stored, f, indent=2, sort_keys=True)
+            f.write("\n")
+        compare(results, dict(), args.tolerance)
+    elif stored["params"] != params:
+        print("baselines were taken at another scale, not comparing")
+        compare(results, dict(), args.tolerance)
+    elif not compare(results, stored["results"], args.tolerance):
+        sys.exit(1)
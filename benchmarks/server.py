@@ -0,0 +1,88 @@
+"""
+Local stand-in for the leaderboard site serving generated pages
+
+Run standalone and point DATASOURCE_URL (and DATASOURCE_URL_BY_DATE) at it:
+    python -m benchmarks.server --port 8089
+    DATASOURCE_URL='http://127.0.0.1:8089/leaderboard?track={track_id}&vehicle={vehicle_id}&page={page}'
+    DATASOURCE_URL_BY_DATE='http://127.0.0.1:8089/leaderboard?track={track_id}&vehicle={vehicle_id}&page={page}&order=date'
+"""
+import argparse
+import asyncio
+import hashlib
+
+from aiohttp import web
+
+from benchmarks.generator import LeaderboardGenerator, render_error_page
+
+URL_TEMPLATE = (
+    "http://{host}:{port}/leaderboard"
+    "?track={{track_id}}&vehicle={{vehicle_id}}&page={{page}}"
+)
+
+
+class LeaderboardServer(object):
+    """
+    Serves generated leaderboards with ETags and counts requests; responses
+    are delayed by latency_seconds to mimic the remote site
+    """
+
+    def __init__(self, generator: LeaderboardGenerator, latency_seconds: float = 0.0):
+        self.generator = generator
+        self.latency_seconds = latency_seconds
+        self.requests = 0
+        self.not_modified = 0
+        self.bytes_sent = 0
+        self._runner = None
+
+    async def leaderboard(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        if self.latency_seconds:
+            await asyncio.sleep(self.latency_seconds)
+        try:
+            track_id = int(request.query["track"])
+            vehicle_id = int(request.query["vehicle"])
+            page = int(request.query.get("page", 1))
+        except (KeyError, ValueError):
+            return web.Response(text=render_error_page(), content_type="text/html")
+        content = self.generator.render_page(
+            track_id, vehicle_id, page, by_date=request.query.get("order") == "date"
+        )
+        etag = f'"{hashlib.sha1(content.encode()).hexdigest()}"'
+        if request.headers.get("If-None-Match") == etag:
+            self.not_modified += 1
+            return web.Response(status=304, headers={"ETag": etag})
+        self.bytes_sent += len(content)
+        return web.Response(
+            text=content, content_type="text/html", headers={"ETag": etag}
+        )
+
+    def create_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get("/leaderboard", self.leaderboard)
+        return app
+
+    async def start(self, host: str = "127.0.0.1", port: int = 8089):
+        self._runner = web.AppRunner(self.create_app())
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--players", type=int, default=20000)
+    parser.add_argument("--records", type=int, default=300)
+    parser.add_argument("--latency", type=float, default=0.0)
+    args = parser.parse_args()
+
+    server = LeaderboardServer(
+        LeaderboardGenerator(args.players, args.records), args.latency
+    )
+    print(URL_TEMPLATE.format(host=args.host, port=args.port))
+    web.run_app(server.create_app(), host=args.host, port=args.port, print=None)
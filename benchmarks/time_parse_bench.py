@@ -0,0 +1,73 @@
+"""
+Benchmarks page-wise time parsing against per-row regex and strptime
+
+Time strings are cut from generated leaderboard pages, e.g.:
+    python -m benchmarks.time_parse_bench --pages 200
+"""
+import argparse
+import re
+from datetime import datetime
+from timeit import timeit
+
+from benchmarks.generator import LeaderboardGenerator, generate_pages
+from page_parse import SECTORS_PATTERN
+from time_parse import parse_datetimes, parse_lap_times
+
+LAP_TIME_PATTERN = re.compile(r'<span class="time">([^<]*)</span>')
+TIMESTAMP_PATTERN = re.compile(r'<td class="timestamp">([^<]*)</td>')
+
+
+def parse_datetime_strptime(s: str) -> datetime:
+    return datetime.strptime(s, r"%d/%m/%Y %H:%M")
+
+
+def parse_lap_time_regex(s: str) -> int:
+    matches = re.fullmatch(r"(\d+):(\d{2})\.(\d{3})", s).groups()
+    minutes, seconds, millis = tuple(map(int, matches))
+    return (minutes * 60 + seconds) * 1000 + millis
+
+
+def parse_per_row(pages: list) -> list:
+    return [
+        (
+            [parse_lap_time_regex(s) for s in lap_times],
+            [parse_datetime_strptime(s) for s in dates],
+        )
+        for lap_times, dates in pages
+    ]
+
+
+def parse_per_page(pages: list) -> list:
+    return [
+        (parse_lap_times(lap_times), parse_datetimes(dates))
+        for lap_times, dates in pages
+    ]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--pages", type=int, default=200)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    pages = [
+        (
+            LAP_TIME_PATTERN.findall(page) + SECTORS_PATTERN.findall(page),
+            TIMESTAMP_PATTERN.findall(page),
+        )
+        for page in generate_pages(LeaderboardGenerator(), args.pages).values()
+    ]
+    if parse_per_page(pages) != parse_per_row(pages):
+        raise AssertionError("page-wise parsing differs from per-row parsing")
+
+    results = dict()
+    for name, function in (
+        ("per row", parse_per_row),
+        ("per page", parse_per_page),
+    ):
+        seconds = min(
+            timeit(lambda: function(pages), number=1) for _ in range(args.repeat)
+        )
+        results[name] = seconds
+        print(f"{name}: {1e6 * seconds / len(pages):.1f} us/page")
+    print(f"speedup: {results['per row'] / results['per page']:.1f}x")
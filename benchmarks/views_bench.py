@@ -0,0 +1,103 @@
+"""
+Benchmarks views.py queries over a synthetic lap_records table
+
+Run from the repository root against a scratch database that was built
+with rebuild_db.py, e.g.:
+    DB_CONNECT_STR=sqlite:///bench.sqlite python -m benchmarks.views_bench
+"""
+import argparse
+import random
+from datetime import datetime, timedelta
+from time import perf_counter
+
+import db
+import views
+from models import LapRecord, Player, Subscription, rebuild_aggregates
+
+CHUNK_SIZE = 50000
+
+
+def fill_lap_records(rows: int, players: int, tracked: int, seed: int = 0):
+    """
+    Inserts about rows synthetic lap records spread evenly over active
+    subscriptions, with the first tracked players added to players
+    """
+    rnd = random.Random(seed)
+    subscription_ids = [
+        id_
+        for id_, in db.session.query(Subscription.id).filter(
+            Subscription.update_interval_hours != None
+        )
+    ]
+    per_subscription = min(players, max(1, rows // len(subscription_ids)))
+    steam_ids = [f"7656119{i:010d}" for i in range(players)]
+    db.session.execute(
+        Player.__table__.insert(),
+        [dict(steam_id=s, name=f"tracked {s}") for s in steam_ids[:tracked]],
+    )
+
+    epoch = datetime(2017, 9, 22)
+    chunk = []
+    for subscription_id in subscription_ids:
+        base_time = rnd.randint(60000, 300000)
+        for player in rnd.sample(range(players), per_subscription):
+            lap_time = base_time + int(rnd.expovariate(1 / 4000))
+            sector = lap_time // 3
+            chunk.append(
+                dict(
+                    subscription_id=subscription_id,
+                    player_id=steam_ids[player],
+                    player_name=f"player {player}",
+                    lap_time=lap_time,
+                    sector1=sector,
+                    sector2=sector,
+                    sector3=lap_time - 2 * sector,
+                    controller_id=rnd.choice("WG"),
+                    upload_date=epoch + timedelta(minutes=rnd.randrange(2 ** 21)),
+                )
+            )
+            if len(chunk) == CHUNK_SIZE:
+                db.session.execute(LapRecord.__table__.insert(), chunk)
+                chunk = []
+    if chunk:
+        db.session.execute(LapRecord.__table__.insert(), chunk)
+    db.session.commit()
+    rebuild_aggregates()
+
+
+def measure(name: str, function, repeat: int):
+    timings = []
+    for _ in range(repeat):
+        start = perf_counter()
+        result = function()
+        timings.append(perf_counter() - start)
+    print(f"{name}: {min(timings) * 1000:.1f} ms ({len(result)} rows)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--rows", type=int, default=2000000)
+    parser.add_argument("--players", type=int, default=200000)
+    parser.add_argument("--tracked", type=int, default=50)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    if db.session.query(LapRecord).first():
+        print("lap_records is not empty, reusing existing data")
+    else:
+        start = perf_counter()
+        fill_lap_records(args.rows, args.players, args.tracked)
+        print(f"filled lap_records in {perf_counter() - start:.1f} s")
+
+    measure(
+        "top tracked per track and class",
+        views.get_top_tracked_per_track_and_class,
+        args.repeat,
+    )
+    for group_by in (("track", "class"), ("vehicle",), ("player",)):
+        measure(
+            f"top 3 per {'/'.join(group_by)}",
+            lambda: views.get_top_records(group_by, n=3, tracked_only=False),
+            args.repeat,
+        )
+    measure("all tracked records", views.get_all_tracked_records, args.repeat)
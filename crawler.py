@@ -0,0 +1,199 @@
+import asyncio
+import heapq
+import itertools
+import random
+import time
+from collections import namedtuple
+from datetime import datetime
+from typing import Awaitable, Callable, Dict, List, Tuple
+from urllib.parse import urlsplit
+
+import aiohttp
+
+from logger import logger
+from settings import (
+    CRAWL_BURST,
+    CRAWL_MAX_CONCURRENCY,
+    CRAWL_MAX_PER_HOST,
+    CRAWL_REQUESTS_PER_SECOND,
+    HTTP_BACKOFF_SECONDS,
+    HTTP_RETRIES,
+    HTTP_TIMEOUT_SECONDS,
+)
+
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+
+# size is the length of the response body in bytes, after content decoding
+FetchResult = namedtuple("FetchResult", ["status", "headers", "content", "size"])
+
+
+async def read_response(response: aiohttp.ClientResponse) -> FetchResult:
+    body = await response.read()
+    # text decodes the body read above instead of reading it again
+    content = await response.text()
+    return FetchResult(response.status, response.headers, content, len(body))
+
+
+def create_http_session() -> aiohttp.ClientSession:
+    """
+    Returns client session with keep-alive connection pooling, DNS cache and
+    per-request timeouts
+    """
+    connector = aiohttp.TCPConnector(
+        limit=CRAWL_MAX_CONCURRENCY,
+        limit_per_host=CRAWL_MAX_PER_HOST,
+        ttl_dns_cache=300,
+        keepalive_timeout=30,
+    )
+    return aiohttp.ClientSession(
+        connector=connector,
+        timeout=aiohttp.ClientTimeout(total=HTTP_TIMEOUT_SECONDS),
+        raise_for_status=True,
+    )
+
+
+def is_retryable(error: Exception) -> bool:
+    if isinstance(error, aiohttp.ClientResponseError):
+        return error.status in RETRYABLE_STATUSES
+    return isinstance(error, (aiohttp.ClientError, asyncio.TimeoutError))
+
+
+class TokenBucket(object):
+    """
+    Token bucket rate limiter; rate <= 0 disables limiting
+    """
+
+    _rate: float
+    _capacity: int
+    _tokens: float
+    _timestamp: float
+
+    def __init__(self, rate: float, capacity: int):
+        self._rate = rate
+        self._capacity = max(capacity, 1)
+        self._tokens = self._capacity
+        self._timestamp = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(
+            self._capacity, self._tokens + (now - self._timestamp) * self._rate
+        )
+        self._timestamp = now
+
+    async def acquire(self):
+        if self._rate <= 0:
+            return
+        async with self._lock:
+            self._refill()
+            while self._tokens < 1:
+                await asyncio.sleep((1 - self._tokens) / self._rate)
+                self._refill()
+            self._tokens -= 1
+
+
+class CrawlScheduler(object):
+    """
+    Schedules subscriptions by priority and keeps a bounded number of
+    requests in flight, limited globally, per host and by a token bucket
+    """
+
+    _global_slots: asyncio.Semaphore
+    _host_slots: Dict[str, asyncio.Semaphore]
+    _bucket: TokenBucket
+    _queue: List[Tuple[tuple, int, object]]
+
+    def __init__(
+        self,
+        max_concurrency: int = CRAWL_MAX_CONCURRENCY,
+        max_per_host: int = CRAWL_MAX_PER_HOST,
+        requests_per_second: float = CRAWL_REQUESTS_PER_SECOND,
+        burst: int = CRAWL_BURST,
+    ):
+        self.max_concurrency = max_concurrency
+        self._max_per_host = max_per_host
+        self._global_slots = asyncio.Semaphore(max_concurrency)
+        self._host_slots = dict()
+        self._bucket = TokenBucket(requests_per_second, burst)
+        self._queue = list()
+        self._counter = itertools.count()
+
+    @staticmethod
+    def priority(subscription, now: datetime = None) -> tuple:
+        """
+        Never updated subscriptions go first, then the ones most overdue
+        relative to their update interval, then by next_update
+        """
+        if subscription.last_update is None or subscription.next_update is None:
+            return (0, 0.0, datetime.min)
+        now = now or datetime.utcnow()
+        overdue_hours = (now - subscription.next_update).total_seconds() / 3600
+        interval = subscription.update_interval_hours or 1
+        return (1, -overdue_hours / interval, subscription.next_update)
+
+    def schedule(self, subscription, now: datetime = None):
+        heapq.heappush(
+            self._queue,
+            (self.priority(subscription, now), next(self._counter), subscription),
+        )
+
+    def __len__(self):
+        return len(self._queue)
+
+    def _host_slot(self, url: str) -> asyncio.Semaphore:
+        host = urlsplit(url).netloc
+        slot = self._host_slots.get(host)
+        if slot is None:
+            slot = asyncio.Semaphore(self._max_per_host)
+            self._host_slots[host] = slot
+        return slot
+
+    async def _fetch_once(
+        self, http_session: aiohttp.ClientSession, url: str, headers: dict
+    ) -> FetchResult:
+        async with self._global_slots, self._host_slot(url):
+            await self._bucket.acquire()
+            async with http_session.get(url, headers=headers) as response:
+                return await read_response(response)
+
+    async def fetch(
+        self,
+        http_session: aiohttp.ClientSession,
+        url: str,
+        headers: dict = None,
+        retries: int = HTTP_RETRIES,
+    ) -> FetchResult:
+        """
+        Fetches url, retrying retryable failures with jittered exponential
+        backoff; slots are released while waiting for a retry
+        """
+        for attempt in range(retries + 1):
+            try:
+                return await self._fetch_once(http_session, url, headers)
+            except Exception as e:
+                if attempt == retries or not is_retryable(e):
+                    raise
+                delay = HTTP_BACKOFF_SECONDS * 2 ** attempt
+                delay = random.uniform(delay / 2, delay)
+                logger.warning(
+                    f"Request to {url} failed ({e!r}), retrying in {delay:.1f}s"
+                )
+                await asyncio.sleep(delay)
+
+    async def run(
+        self, worker: Callable[[object], Awaitable], workers: int = None
+    ):
+        """
+        Drains the queue in priority order with a fixed pool of workers, so
+        the number of requests in flight stays steady instead of bursting
+        """
+        workers = workers or self.max_concurrency
+
+        async def _work():
+            while self._queue:
+                _, _, item = heapq.heappop(self._queue)
+                await worker(item)
+
+        logger.debug(f"Crawling {len(self._queue)} items with {workers} workers")
+        await asyncio.gather(*(_work() for _ in range(workers)))
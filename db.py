@@ -1,4 +1,5 @@
 from sqlalchemy import create_engine
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
@@ -8,3 +9,12 @@ from settings import DB_CONNECT_STR
 base = declarative_base(cls=BaseMixin)
 engine = create_engine(DB_CONNECT_STR)
 session = sessionmaker(bind=engine, autocommit=False, autoflush=False)()
+
+
+def upsert(table):
+    """
+    Returns dialect specific INSERT statement supporting ON CONFLICT clauses
+    """
+    if engine.dialect.name == "postgresql":
+        return postgresql.insert(table)
+    return sqlite.insert(table)
@@ -0,0 +1,185 @@
+import asyncio
+import json
+from datetime import datetime
+from typing import List
+
+import aiohttp
+from sqlalchemy import delete, update
+
+import db
+from logger import logger
+from models import DiscordMessage
+from settings import DISCORD_MAX_ATTEMPTS, DISCORD_POLL_SECONDS, DISCORD_WEBHOOK
+from steam_api import steam_profiles
+
+# discord accepts up to 10 embeds per webhook message
+MAX_EMBEDS = 10
+
+
+def _is_rejected(status: int) -> bool:
+    # client errors other than rate limits fail again however often retried
+    return status is not None and 400 <= status < 500 and status != 429
+
+
+def queue_discord_message(title: str, description: str, steam_id: str = None):
+    """
+    Stores embed for delivery by DiscordDispatcher
+    """
+    embed = {"title": title, "description": description}
+    db.session.add(DiscordMessage(embed=json.dumps(embed), steam_id=steam_id))
+    db.session.commit()
+
+
+class DiscordDispatcher(object):
+    """
+    Background worker delivering queued messages to the webhook, packing up
+    to MAX_EMBEDS embeds per request and honoring discord rate limits
+    """
+
+    def __init__(
+        self,
+        webhook: str = DISCORD_WEBHOOK,
+        poll_seconds: float = DISCORD_POLL_SECONDS,
+    ):
+        self._webhook = webhook
+        self._poll_seconds = poll_seconds
+        self._stopping = None
+        self._task = None
+
+    async def _build_embeds(self, messages: List[DiscordMessage]) -> List[dict]:
+        steam_ids = list({m.steam_id for m in messages if m.steam_id})
+        try:
+            avatar_urls = await steam_profiles.get_avatar_urls_async(steam_ids)
+        except Exception:
+            # a missing avatar should never hold back a notification
+            logger.exception("Failed to get avatar urls")
+            avatar_urls = dict()
+        embeds = []
+        for message in messages:
+            embed = json.loads(message.embed)
+            avatar_url = avatar_urls.get(message.steam_id)
+            if avatar_url:
+                embed["thumbnail"] = {"url": avatar_url}
+            embeds.append(embed)
+        return embeds
+
+    async def _post(
+        self, http_session: aiohttp.ClientSession, embeds: List[dict]
+    ) -> int:
+        """
+        Returns the response status, waiting out rate limits
+        """
+        while True:
+            async with http_session.post(
+                self._webhook, json={"embeds": embeds}
+            ) as response:
+                if response.status == 429:
+                    data = await response.json(content_type=None)
+                    retry_after = float(
+                        data.get("retry_after")
+                        or response.headers.get("Retry-After", 1)
+                    )
+                    logger.warning(f"Discord rate limited, retrying in {retry_after}s")
+                    await asyncio.sleep(retry_after)
+                    continue
+                if response.headers.get("X-RateLimit-Remaining") == "0":
+                    await asyncio.sleep(
+                        float(response.headers.get("X-RateLimit-Reset-After", 0))
+                    )
+                return response.status
+
+    async def drain(self, http_session: aiohttp.ClientSession) -> int:
+        """
+        Sends queued messages oldest first until the queue is empty or a
+        delivery fails, returns number of messages sent
+
+        Messages rejected by discord are given up at once; after other
+        failures they stay queued until DISCORD_MAX_ATTEMPTS is reached.
+        """
+        sent = 0
+        # last message of a rejected batch, until then messages go one by one
+        split_until = None
+        table = DiscordMessage.__table__
+        while True:
+            messages = (
+                db.session.query(DiscordMessage)
+                .filter(DiscordMessage.failed_at == None)
+                .order_by(DiscordMessage.id)
+                .limit(MAX_EMBEDS if split_until is None else 1)
+                .all()
+            )
+            if not messages:
+                return sent
+            ids = [m.id for m in messages]
+            if split_until is not None and ids[-1] >= split_until:
+                split_until = None
+            embeds = await self._build_embeds(messages)
+            try:
+                status = await self._post(http_session, embeds)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logger.error(f"Discord webhook failed: {e!r}")
+                status = None
+            if status is not None and status < 300:
+                db.session.execute(delete(table).where(table.c.id.in_(ids)))
+                db.session.commit()
+                sent += len(ids)
+                continue
+            if status is not None:
+                logger.error(f"Discord webhook failed with status {status}")
+            rejected = _is_rejected(status)
+            if rejected and len(ids) > 1:
+                # send the messages one by one to give up only the rejected one
+                split_until = ids[-1]
+                continue
+            attempted = table.c.id.in_(ids)
+            db.session.execute(
+                update(table)
+                .where(attempted)
+                .values(attempts=table.c.attempts + 1)
+            )
+            if not rejected:
+                attempted &= table.c.attempts >= DISCORD_MAX_ATTEMPTS
+            given_up = db.session.execute(
+                update(table).where(attempted).values(failed_at=datetime.utcnow())
+            ).rowcount
+            db.session.commit()
+            if given_up:
+                logger.error(f"Gave up {given_up} discord messages")
+            if not rejected:
+                # retried on the next poll
+                return sent
+
+    async def _run(self):
+        async with aiohttp.ClientSession() as http_session:
+            while True:
+                try:
+                    await self.drain(http_session)
+                except Exception:
+                    logger.exception("Discord dispatcher failed")
+                if self._stopping.is_set():
+                    return
+                try:
+                    await asyncio.wait_for(
+                        self._stopping.wait(), self._poll_seconds
+                    )
+                except asyncio.TimeoutError:
+                    pass
+
+    def start(self):
+        self._stopping = asyncio.Event()
+        self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        """
+        Stops the worker after a final drain of the queue
+        """
+        self._stopping.set()
+        await self._task
+
+    async def flush(self) -> int:
+        async with aiohttp.ClientSession() as http_session:
+            return await self.drain(http_session)
+
+
+def flush_discord_messages() -> int:
+    return asyncio.run(DiscordDispatcher().flush())
@@ -1,25 +1,10 @@
-import requests
-
+from discord_dispatcher import queue_discord_message
 from events import (
     improved_record_event,
     new_record_event,
     new_tracked_player_event,
 )
 from models import LapRecord, Player
-from settings import DISCORD_WEBHOOK
-from steam_api import get_steam_user_avatar_url
-
-
-def send_discord_message(payload):
-    response = requests.post(DISCORD_WEBHOOK, json=payload)
-    return response.status_code == 204
-
-
-def format_discord_payload(title: str, description: str, steam_id: str = None):
-    payload = {"title": title, "description": description}
-    if steam_id:
-        payload["thumbnail"] = {"url": get_steam_user_avatar_url(steam_id)}
-    return {"embeds": [payload]}
 
 
 def send_new_tracked_player_message(player: Player, found_records_count: int):
@@ -28,12 +13,11 @@ def send_new_tracked_player_message(player: Player, found_records_count: int):
         message += (
             f". Found {found_records_count} lap records already in database"
         )
-    payload = format_discord_payload(
+    queue_discord_message(
         title="New tracked player",
         description=message,
         steam_id=player.steam_id,
     )
-    send_discord_message(payload)
 
 
 new_tracked_player_event.add_observer(0, send_new_tracked_player_message)
@@ -46,12 +30,11 @@ def send_new_record_message(lap_record: LapRecord):
     Track: {lap_record.subscription.track}
     Vehicle: {lap_record.subscription.vehicle}, class: {lap_record.subscription.vehicle.class_}
     """
-    payload = format_discord_payload(
+    queue_discord_message(
         title="New record found",
         description=message,
         steam_id=lap_record.player_id,
     )
-    send_discord_message(payload)
 
 
 new_record_event.add_observer(0, send_new_record_message)
@@ -67,12 +50,11 @@ def send_improved_record_message(lap_record: LapRecord, old_time: int):
     Track: {lap_record.subscription.track}
     Vehicle: {lap_record.subscription.vehicle}, class: {lap_record.subscription.vehicle.class_}
     """
-    payload = format_discord_payload(
+    queue_discord_message(
         title="Improved record found",
         description=message,
         steam_id=lap_record.player_id,
     )
-    send_discord_message(payload)
 
 
 improved_record_event.add_observer(0, send_improved_record_message)
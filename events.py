@@ -1,26 +1,183 @@
-from typing import Callable, Dict
+import asyncio
+import threading
+from concurrent.futures import Executor, Future
+from time import perf_counter
+from typing import Callable, Dict, List
+
+from logger import logger
+from settings import EVENT_MAX_PENDING
+
+
+class ObserverStats(object):
+    calls: int
+    errors: int
+    dropped: int
+    total_seconds: float
+    max_seconds: float
+    pending: int
+    max_pending: int
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.dropped = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+        self.pending = 0
+        self.max_pending = 0
+
+    def as_dict(self) -> dict:
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "dropped": self.dropped,
+            "avg_seconds": self.total_seconds / self.calls if self.calls else 0.0,
+            "max_seconds": self.max_seconds,
+            "pending": self.pending,
+            "max_pending": self.max_pending,
+        }
+
+
+class _Observer(object):
+    """
+    Wraps an observer callback; sync callbacks run inline or in their
+    executor, coroutine functions run as tasks on the running event loop
+    """
+
+    def __init__(
+        self,
+        name: str,
+        callback: Callable,
+        executor: Executor = None,
+        max_pending: int = EVENT_MAX_PENDING,
+    ):
+        self.name = name
+        self.callback = callback
+        self.executor = executor
+        self.max_pending = max_pending
+        self.is_async = asyncio.iscoroutinefunction(callback)
+        self.stats = ObserverStats()
+        self.futures = set()
+        self._lock = threading.Lock()
+
+    def _record(self, start: float, failed: bool):
+        elapsed = perf_counter() - start
+        with self._lock:
+            self.stats.calls += 1
+            self.stats.total_seconds += elapsed
+            self.stats.max_seconds = max(self.stats.max_seconds, elapsed)
+            if failed:
+                self.stats.errors += 1
+        if failed:
+            logger.exception(f"Observer {self.name} failed")
+
+    def _call(self, args: tuple):
+        start = perf_counter()
+        try:
+            self.callback(*args)
+        except Exception:
+            self._record(start, True)
+        else:
+            self._record(start, False)
+
+    async def _call_async(self, args: tuple):
+        start = perf_counter()
+        try:
+            await self.callback(*args)
+        except Exception:
+            self._record(start, True)
+        else:
+            self._record(start, False)
+
+    def _done(self, future):
+        with self._lock:
+            self.stats.pending -= 1
+            self.futures.discard(future)
+
+    def _track(self, future):
+        with self._lock:
+            self.stats.pending += 1
+            self.stats.max_pending = max(self.stats.max_pending, self.stats.pending)
+            self.futures.add(future)
+        future.add_done_callback(self._done)
+
+    def dispatch(self, args: tuple):
+        if self.is_async:
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                asyncio.run(self._call_async(args))
+                return
+            if self.stats.pending >= self.max_pending:
+                # a coroutine cannot be awaited from publish, shed the event
+                with self._lock:
+                    self.stats.dropped += 1
+                logger.warning(f"Observer {self.name} is backlogged, event dropped")
+                return
+            self._track(loop.create_task(self._call_async(args)))
+        elif self.executor and self.stats.pending < self.max_pending:
+            self._track(self.executor.submit(self._call, args))
+        else:
+            # inline, also when the executor is backlogged, which slows the
+            # publisher down instead of queueing without bound
+            self._call(args)
 
 
 class Event(object):
     _event_name: str
-    _observers: Dict[object, Callable]
+    _observers: Dict[object, _Observer]
 
     def __init__(self, event_name):
         self._event_name = event_name
         self._observers = dict()
+        self.published = 0
 
-    def add_observer(self, observer: object, callback: Callable):
+    def add_observer(
+        self,
+        observer: object,
+        callback: Callable,
+        executor: Executor = None,
+        max_pending: int = EVENT_MAX_PENDING,
+    ):
+        """
+        Registers callback, which may be a coroutine function; sync callbacks
+        given an executor are dispatched to it instead of running inline
+        """
         if observer in self._observers.keys():
             raise ValueError()
-        self._observers[observer] = callback
+        self._observers[observer] = _Observer(
+            f"{observer!r} of {self._event_name}", callback, executor, max_pending
+        )
 
     def remove_observer(self, observer: object):
         # raises KeyError if observer not in self._observers
         del self._observers[observer]
 
     def publish(self, *args):
-        for callback in self._observers.values():
-            callback(*args)
+        # observer failures are logged and never reach the publisher
+        self.published += 1
+        for observer in list(self._observers.values()):
+            observer.dispatch(args)
+
+    async def drain(self):
+        """
+        Waits for all dispatched observer calls to finish
+        """
+        for observer in list(self._observers.values()):
+            pending = [
+                asyncio.wrap_future(f) if isinstance(f, Future) else f
+                for f in list(observer.futures)
+            ]
+            await asyncio.gather(*pending)
+
+    def metrics(self) -> dict:
+        return {
+            "event": self._event_name,
+            "published": self.published,
+            "observers": {
+                o.name: o.stats.as_dict() for o in self._observers.values()
+            },
+        }
 
 
 new_tracked_player_event = Event("New Tracked Player")
@@ -28,3 +185,16 @@ new_record_event = Event("New Record")
 improved_record_event = Event("Improved Record")
 update_session_start_event = Event("Update Session Start")
 update_session_end_event = Event("Update Session End")
+
+all_events: List[Event] = [
+    new_tracked_player_event,
+    new_record_event,
+    improved_record_event,
+    update_session_start_event,
+    update_session_end_event,
+]
+
+
+async def drain_events():
+    for event in all_events:
+        await event.drain()
@@ -0,0 +1,291 @@
+import os
+import socket
+import uuid
+from datetime import datetime, timedelta
+from typing import Tuple
+
+from sqlalchemy import DateTime, and_, delete, func, literal, or_, select, update
+
+import db
+from logger import logger
+from models import Subscription, UpdateJob
+from settings import (
+    UPDATE_JOB_BACKOFF_SECONDS,
+    UPDATE_JOB_LEASE_SECONDS,
+    UPDATE_JOB_MAX_ATTEMPTS,
+    UPDATE_JOB_RETENTION_HOURS,
+)
+
+OPEN_STATUSES = (UpdateJob.PENDING, UpdateJob.RUNNING)
+FINISHED_STATUSES = (UpdateJob.DONE, UpdateJob.FAILED, UpdateJob.CANCELLED)
+
+
+def new_owner() -> str:
+    """
+    Returns lease owner name of an update run, unique across processes and
+    machines
+    """
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+def _owned(owner: str):
+    return and_(UpdateJob.lease_owner == owner, UpdateJob.status == UpdateJob.RUNNING)
+
+
+def enqueue(subscriptions, now: datetime) -> int:
+    """
+    Adds a pending job for every subscription of a query without an open
+    job, in query order
+
+    Parameters:
+    subscriptions (Query): subscriptions to refresh, e.g. due ones
+
+    Returns:
+    int: number of jobs added
+    """
+    has_open_job = (
+        select(UpdateJob.id)
+        .where(UpdateJob.subscription_id == Subscription.id)
+        .where(UpdateJob.status.in_(OPEN_STATUSES))
+        .exists()
+    )
+    rows = subscriptions.filter(~has_open_job).with_entities(
+        Subscription.id,
+        literal(UpdateJob.PENDING),
+        literal(0),
+        literal(now, DateTime),
+        literal(now, DateTime),
+    )
+    result = db.session.execute(
+        UpdateJob.__table__.insert().from_select(
+            ["subscription_id", "status", "attempts", "created_at", "available_at"],
+            rows.statement,
+        )
+    )
+    db.session.commit()
+    return result.rowcount
+
+
+def _claimable(now: datetime):
+    # pending jobs past their backoff and running jobs with an expired lease,
+    # left behind by a run that died
+    return or_(
+        and_(UpdateJob.status == UpdateJob.PENDING, UpdateJob.available_at <= now),
+        and_(UpdateJob.status == UpdateJob.RUNNING, UpdateJob.leased_until < now),
+    )
+
+
+def cancel_stale(now: datetime) -> int:
+    """
+    Cancels claimable jobs of subscriptions deactivated or no longer due,
+    e.g. refreshed by a forced run since the job was added
+
+    Returns:
+    int: number of cancelled jobs
+    """
+    stale = select(Subscription.id).where(
+        or_(
+            Subscription.update_interval_hours == None,
+            and_(Subscription.last_update != None, Subscription.next_update > now),
+        )
+    )
+    result = db.session.execute(
+        update(UpdateJob)
+        .where(_claimable(now))
+        .where(UpdateJob.subscription_id.in_(stale))
+        .values(status=UpdateJob.CANCELLED, leased_until=None, finished_at=now),
+        execution_options={"synchronize_session": False},
+    )
+    db.session.commit()
+    if result.rowcount:
+        logger.info(f"Cancelled {result.rowcount} stale update jobs")
+    return result.rowcount
+
+
+def claim(
+    owner: str, limit: int, now: datetime, shard: Tuple[int, int] = None
+) -> int:
+    """
+    Leases up to limit jobs in queue order, -1 for all of them; stale jobs
+    are cancelled first, see cancel_stale
+
+    Returns:
+    int: number of claimed jobs
+    """
+    cancel_stale(now)
+    claimable = _claimable(now)
+    active = select(Subscription.id).where(Subscription.update_interval_hours != None)
+    ids = (
+        select(UpdateJob.id)
+        .where(claimable)
+        .where(UpdateJob.subscription_id.in_(active))
+    )
+    if shard:
+        index, count = shard
+        ids = ids.where(UpdateJob.subscription_id % count == index)
+    ids = ids.order_by(UpdateJob.available_at, UpdateJob.id)
+    if limit >= 0:
+        ids = ids.limit(limit)
+    # claimable is checked again, so concurrent runs never lease the same job
+    result = db.session.execute(
+        update(UpdateJob)
+        .where(UpdateJob.id.in_(ids))
+        .where(claimable)
+        .values(
+            status=UpdateJob.RUNNING,
+            lease_owner=owner,
+            leased_until=now + timedelta(seconds=UPDATE_JOB_LEASE_SECONDS),
+            started_at=now,
+            attempts=UpdateJob.attempts + 1,
+        ),
+        execution_options={"synchronize_session": False},
+    )
+    db.session.commit()
+    return result.rowcount
+
+
+def claimed_subscriptions_query(owner: str):
+    return (
+        db.session.query(Subscription)
+        .join(UpdateJob, UpdateJob.subscription_id == Subscription.id)
+        .filter(_owned(owner))
+    )
+
+
+def renew_leases(owner: str, now: datetime = None) -> int:
+    """
+    Extends leases of all running jobs of owner
+    """
+    now = now or datetime.utcnow()
+    result = db.session.execute(
+        update(UpdateJob)
+        .where(_owned(owner))
+        .values(leased_until=now + timedelta(seconds=UPDATE_JOB_LEASE_SECONDS)),
+        execution_options={"synchronize_session": False},
+    )
+    db.session.commit()
+    return result.rowcount
+
+
+def complete(owner: str, subscription_ids: list, now: datetime = None):
+    """
+    Marks jobs of subscriptions done; not committed, so it is part of the
+    transaction persisting their records
+    """
+    db.session.execute(
+        update(UpdateJob)
+        .where(_owned(owner))
+        .where(UpdateJob.subscription_id.in_(subscription_ids))
+        .values(status=UpdateJob.DONE, finished_at=now or datetime.utcnow()),
+        execution_options={"synchronize_session": False},
+    )
+
+
+def fail(owner: str, subscription_id: int, error: str, now: datetime = None):
+    """
+    Returns the job of a subscription to the queue with exponential backoff,
+    or marks it failed after UPDATE_JOB_MAX_ATTEMPTS attempts
+    """
+    now = now or datetime.utcnow()
+    job = (
+        db.session.query(UpdateJob)
+        .filter(_owned(owner))
+        .filter(UpdateJob.subscription_id == subscription_id)
+        .first()
+    )
+    if not job:
+        return
+    job.last_error = error
+    job.leased_until = None
+    if job.attempts >= UPDATE_JOB_MAX_ATTEMPTS:
+        job.status = UpdateJob.FAILED
+        job.finished_at = now
+        logger.error(f"{job} failed after {job.attempts} attempts")
+    else:
+        job.status = UpdateJob.PENDING
+        job.available_at = now + timedelta(
+            seconds=UPDATE_JOB_BACKOFF_SECONDS * 2 ** (job.attempts - 1)
+        )
+    db.session.commit()
+
+
+def release(owner: str) -> int:
+    """
+    Returns jobs still leased by owner to the queue without counting the
+    attempt, e.g. when a run is interrupted
+    """
+    result = db.session.execute(
+        update(UpdateJob)
+        .where(_owned(owner))
+        .values(
+            status=UpdateJob.PENDING,
+            leased_until=None,
+            attempts=UpdateJob.attempts - 1,
+        ),
+        execution_options={"synchronize_session": False},
+    )
+    db.session.commit()
+    return result.rowcount
+
+
+def purge(now: datetime = None) -> int:
+    """
+    Deletes finished jobs older than UPDATE_JOB_RETENTION_HOURS
+    """
+    now = now or datetime.utcnow()
+    result = db.session.execute(
+        delete(UpdateJob)
+        .where(UpdateJob.status.in_(FINISHED_STATUSES))
+        .where(
+            UpdateJob.finished_at < now - timedelta(hours=UPDATE_JOB_RETENTION_HOURS)
+        )
+    )
+    db.session.commit()
+    return result.rowcount
+
+
+def queue_stats(now: datetime = None) -> dict:
+    """
+    Returns job counts by status, retries waiting for backoff, age of the
+    oldest open job and jobs finished per hour over the last hour with their
+    mean run time
+    """
+    now = now or datetime.utcnow()
+    counts = dict(
+        db.session.query(UpdateJob.status, func.count()).group_by(UpdateJob.status)
+    )
+    retrying = (
+        db.session.query(func.count())
+        .select_from(UpdateJob)
+        .filter(UpdateJob.status == UpdateJob.PENDING)
+        .filter(UpdateJob.attempts > 0)
+        .scalar()
+    )
+    oldest = (
+        db.session.query(func.min(UpdateJob.created_at))
+        .filter(UpdateJob.status.in_(OPEN_STATUSES))
+        .scalar()
+    )
+    finished = (
+        db.session.query(UpdateJob.started_at, UpdateJob.finished_at)
+        .filter(UpdateJob.status == UpdateJob.DONE)
+        .filter(UpdateJob.finished_at >= now - timedelta(hours=1))
+        .all()
+    )
+    run_seconds = [(f - s).total_seconds() for s, f in finished if s and f]
+    return {
+        "counts": {status: counts.get(status, 0) for status in UpdateJob.STATUSES},
+        "retrying": retrying,
+        "lag_hours": (now - oldest).total_seconds() / 3600 if oldest else 0.0,
+        "done_last_hour": len(finished),
+        "mean_run_seconds": (
+            sum(run_seconds) / len(run_seconds) if run_seconds else None
+        ),
+    }
+
+
+if __name__ == "__main__":
+    import json
+
+    # usage: python job_queue.py
+    print(json.dumps(queue_stats(), indent=2))
@@ -1,9 +1,20 @@
+import multiprocessing
+
 import db
+from discord_dispatcher import flush_discord_messages
 
 # import hooks
 from events import new_tracked_player_event
+from logger import logger
+from metrics import run_metrics
 from models import LapRecord, Player, Subscription
-from settings import HIGH_UPDATE_INTERVAL
+from scheduling import rebalance_intervals
+from settings import (
+    DISCORD_WEBHOOK,
+    HIGH_UPDATE_INTERVAL,
+    UPDATE_REQUESTS_PER_HOUR,
+    UPDATE_WORKERS,
+)
 from update import update_high_interval_only, update_records
 
 
@@ -17,6 +28,8 @@ def add_player(steam_id: str, name: str, update_intervals: bool = True):
     )
 
     new_tracked_player_event.publish(player, player_records)
+    if DISCORD_WEBHOOK:
+        flush_discord_messages()
 
     if update_intervals:
         for record in player.lap_records:
@@ -27,5 +40,56 @@ def add_player(steam_id: str, name: str, update_intervals: bool = True):
     return True
 
 
+def _update_shard(index: int, count: int, limit: int, forced: bool):
+    run_metrics.labels["shard"] = str(index)
+    update_records(limit, forced, shard=(index, count))
+
+
+def update_records_parallel(
+    workers: int = UPDATE_WORKERS, limit: int = -1, forced: bool = False
+) -> bool:
+    """
+    Updates due subscriptions in worker processes, each with its own event
+    loop, HTTP session and DB connection. Worker i takes subscriptions with
+    id % workers == i, so no leaderboard is scraped twice, and a share of the
+    crawl concurrency and request rate. Intervals are rebalanced and Discord
+    messages sent once all workers are done.
+
+    With SQLite the workers still take turns writing; use PostgreSQL to
+    scale persistence as well.
+    """
+    # spawned workers import their own engine instead of sharing a connection
+    context = multiprocessing.get_context("spawn")
+    processes = []
+    for index in range(workers):
+        # limit == -1 means no limit, otherwise it is split between shards
+        shard_limit = limit
+        if limit >= 0:
+            shard_limit = limit // workers + (index < limit % workers)
+        processes.append(
+            context.Process(
+                target=_update_shard,
+                args=(index, workers, shard_limit, forced),
+                name=f"update-shard-{index}",
+            )
+        )
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+    failed = [p.name for p in processes if p.exitcode != 0]
+    if failed:
+        logger.error(f"Update workers failed: {', '.join(failed)}")
+    if UPDATE_REQUESTS_PER_HOUR:
+        rebalance_intervals()
+    if DISCORD_WEBHOOK:
+        flush_discord_messages()
+    return not failed
+
+
 if __name__ == "__main__":
-    update_records(100)
+    if UPDATE_WORKERS > 1:
+        update_records_parallel(UPDATE_WORKERS, 100)
+    else:
+        update_records(100)
@@ -0,0 +1,251 @@
+import cProfile
+import json
+import os
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime
+from time import perf_counter
+from typing import Dict, Sequence
+
+from events import update_session_end_event, update_session_start_event
+from logger import logger
+from settings import (
+    METRICS_PROMETHEUS_PATH,
+    METRICS_REPORT_PATH,
+    PROFILE_PATH,
+    PROFILER,
+)
+
+METRICS_PREFIX = "leaderboards_"
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+class Histogram(object):
+    buckets: Sequence[float]
+    counts: list
+    count: int
+    sum: float
+
+    def __init__(self, buckets: Sequence[float] = SECONDS_BUCKETS):
+        self.buckets = tuple(buckets)
+        # the last slot counts observations above the largest bucket
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self) -> Dict[str, int]:
+        """
+        Returns observation counts per upper bound, cumulative as in Prometheus
+        """
+        total = 0
+        result = dict()
+        for bound, count in zip(self.buckets + ("+Inf",), self.counts):
+            total += count
+            result[str(bound)] = total
+        return result
+
+    def as_dict(self) -> dict:
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "avg": self.sum / self.count if self.count else 0.0,
+            "buckets": self.cumulative(),
+        }
+
+
+class RunMetrics(object):
+    """
+    Counters, histograms and gauges of a single update run; reset when an
+    update session starts and reported when it ends. labels, such as the
+    shard of a crawler process, are kept across runs.
+    """
+
+    def __init__(self):
+        self.labels: Dict[str, str] = dict()
+        self.reset()
+
+    def reset(self):
+        self.started_at = None
+        self.finished_at = None
+        self._start = None
+        self.seconds = None
+        self.counters = defaultdict(int)
+        self.histograms = defaultdict(Histogram)
+        self.gauges = dict()
+        self.gauge_maxima = dict()
+
+    def inc(self, name: str, value: int = 1):
+        self.counters[name] += value
+
+    def observe(self, name: str, value: float):
+        self.histograms[name].observe(value)
+
+    def set_gauge(self, name: str, value: float):
+        self.gauges[name] = value
+        self.gauge_maxima[name] = max(value, self.gauge_maxima.get(name, value))
+
+    @contextmanager
+    def timer(self, name: str):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, perf_counter() - start)
+
+    def start(self):
+        self.reset()
+        self.started_at = datetime.utcnow()
+        self._start = perf_counter()
+
+    def finish(self):
+        self.finished_at = datetime.utcnow()
+        if self._start is not None:
+            self.seconds = perf_counter() - self._start
+
+    def as_dict(self) -> dict:
+        return {
+            "labels": dict(self.labels),
+            "started_at": self.started_at and self.started_at.isoformat(),
+            "finished_at": self.finished_at and self.finished_at.isoformat(),
+            "seconds": self.seconds,
+            "counters": dict(self.counters),
+            "histograms": {
+                name: histogram.as_dict()
+                for name, histogram in self.histograms.items()
+            },
+            "gauges": {
+                name: {"last": value, "max": self.gauge_maxima[name]}
+                for name, value in self.gauges.items()
+            },
+        }
+
+    def _labels(self, **extra) -> str:
+        labels = dict(self.labels, **extra)
+        if not labels:
+            return ""
+        return "{" + ",".join(f'{k}="{v}"' for k, v in labels.items()) + "}"
+
+    def to_prometheus(self, prefix: str = METRICS_PREFIX) -> str:
+        """
+        Returns metrics in the Prometheus text exposition format
+        """
+        lines = []
+        labels = self._labels()
+        if self.seconds is not None:
+            lines += [
+                f"# TYPE {prefix}run_seconds gauge",
+                f"{prefix}run_seconds{labels} {self.seconds}",
+            ]
+        for name, value in sorted(self.counters.items()):
+            lines += [
+                f"# TYPE {prefix}{name}_total counter",
+                f"{prefix}{name}_total{labels} {value}",
+            ]
+        for name, histogram in sorted(self.histograms.items()):
+            lines.append(f"# TYPE {prefix}{name} histogram")
+            for bound, count in histogram.cumulative().items():
+                lines.append(
+                    f"{prefix}{name}_bucket{self._labels(le=bound)} {count}"
+                )
+            lines += [
+                f"{prefix}{name}_sum{labels} {histogram.sum}",
+                f"{prefix}{name}_count{labels} {histogram.count}",
+            ]
+        for name, value in sorted(self.gauges.items()):
+            lines += [
+                f"# TYPE {prefix}{name} gauge",
+                f"{prefix}{name}{labels} {value}",
+                f"# TYPE {prefix}{name}_max gauge",
+                f"{prefix}{name}_max{labels} {self.gauge_maxima[name]}",
+            ]
+        return "\n".join(lines) + "\n"
+
+
+run_metrics = RunMetrics()
+
+
+def labelled_path(path: str, metrics: RunMetrics = run_metrics) -> str:
+    """
+    Returns path with the metrics labels inserted before its extension, so
+    crawler processes do not overwrite each other's files
+    """
+    if not metrics.labels:
+        return path
+    root, extension = os.path.splitext(path)
+    labels = "".join(f".{k}{v}" for k, v in metrics.labels.items())
+    return f"{root}{labels}{extension}"
+
+
+def write_run_report(metrics: RunMetrics = run_metrics):
+    """
+    Writes the JSON run report and the Prometheus textfile, if configured
+    """
+    if METRICS_REPORT_PATH:
+        path = labelled_path(METRICS_REPORT_PATH, metrics)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(metrics.as_dict(), f, indent=2)
+    if METRICS_PROMETHEUS_PATH:
+        path = labelled_path(METRICS_PROMETHEUS_PATH, metrics)
+        # written aside and renamed, so scrapers never read a partial file
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            f.write(metrics.to_prometheus())
+        os.replace(path + ".tmp", path)
+    counters = metrics.counters
+    logger.info(
+        f"Update run took {metrics.seconds or 0:.1f}s: "
+        f"{counters['requests']} requests, "
+        f"{counters['response_bytes'] / 2 ** 20:.1f} MiB, "
+        f"{counters['lap_records_new']} new and "
+        f"{counters['lap_records_improved']} improved records"
+    )
+
+
+def _finish_run():
+    run_metrics.finish()
+    write_run_report()
+
+
+update_session_start_event.add_observer(run_metrics, run_metrics.start)
+update_session_end_event.add_observer(run_metrics, _finish_run)
+
+
+@contextmanager
+def profiled(profiler: str = PROFILER, path: str = None):
+    """
+    Profiles the enclosed block with "cprofile" or "pyinstrument" and saves
+    the result to path, PROFILE_PATH by default; an empty profiler runs the
+    block unprofiled
+    """
+    if not profiler:
+        yield
+        return
+    path = path or labelled_path(PROFILE_PATH)
+    if profiler == "cprofile":
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            profile.dump_stats(path)
+    elif profiler == "pyinstrument":
+        # optional dependency, only needed in this mode
+        from pyinstrument import Profiler
+
+        profile = Profiler(async_mode="enabled")
+        profile.start()
+        try:
+            yield
+        finally:
+            profile.stop()
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(profile.output_html())
+    else:
+        raise ValueError(f"unknown profiler '{profiler}'")
+    logger.info(f"Saved {profiler} profile to {path}")
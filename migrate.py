@@ -0,0 +1,183 @@
+from datetime import datetime
+from time import perf_counter
+
+from sqlalchemy import func, inspect, text
+
+import db
+from logger import logger
+from models import (
+    LapRecord,
+    LapRecordHistory,
+    Player,
+    Subscription,
+    SubscriptionBest,
+    Track,
+    TrackClassBest,
+    Vehicle,
+    rebuild_aggregates,
+)
+from update import due_subscriptions_query
+
+
+def _has_unique_track_vehicle(inspector) -> bool:
+    constraints = inspector.get_unique_constraints("subscriptions")
+    constraints += [
+        index
+        for index in inspector.get_indexes("subscriptions")
+        if index["unique"]
+    ]
+    return any(
+        set(c["column_names"]) == {"track_id", "vehicle_id"} for c in constraints
+    )
+
+
+def remove_duplicate_subscriptions():
+    """
+    Merges subscriptions sharing track and vehicle into the oldest one;
+    clashing lap records of duplicates are dropped and scraped again later
+    """
+    duplicates = db.session.execute(
+        text(
+            "SELECT s.id, k.keep_id FROM subscriptions s JOIN ("
+            "SELECT track_id, vehicle_id, min(id) AS keep_id FROM subscriptions "
+            "GROUP BY track_id, vehicle_id HAVING count(*) > 1"
+            ") k ON s.track_id = k.track_id AND s.vehicle_id = k.vehicle_id "
+            "WHERE s.id != k.keep_id"
+        )
+    ).all()
+    for duplicate_id, keep_id in duplicates:
+        params = {"duplicate_id": duplicate_id, "keep_id": keep_id}
+        db.session.execute(
+            text(
+                "UPDATE lap_records SET subscription_id = :keep_id "
+                "WHERE subscription_id = :duplicate_id AND player_id NOT IN "
+                "(SELECT player_id FROM lap_records WHERE subscription_id = :keep_id)"
+            ),
+            params,
+        )
+        db.session.execute(
+            text("DELETE FROM lap_records WHERE subscription_id = :duplicate_id"),
+            params,
+        )
+        db.session.execute(
+            text("DELETE FROM subscriptions WHERE id = :duplicate_id"), params
+        )
+    db.session.commit()
+    logger.info(f"Removed {len(duplicates)} duplicate subscriptions")
+
+
+def add_missing_columns(inspector):
+    """
+    Adds nullable columns of the models missing from existing tables
+    """
+    for table in db.base.metadata.sorted_tables:
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            if not column.nullable:
+                raise ValueError(
+                    f"cannot add NOT NULL column {table.name}.{column.name}"
+                )
+            type_ = column.type.compile(dialect=db.engine.dialect)
+            db.session.execute(
+                text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {type_}")
+            )
+            logger.info(f"Added column '{table.name}.{column.name}'")
+    db.session.commit()
+
+
+def migrate():
+    """
+    Brings an existing database up to the current schema: creates missing
+    tables, columns and indexes, fills new history and best lap tables and
+    enforces the unique track and vehicle constraint
+    """
+    logger.info("Started migrating database")
+    # creates tables added since the database was built, existing ones are kept
+    db.base.metadata.create_all(bind=db.engine)
+    inspector = inspect(db.engine)
+    add_missing_columns(inspector)
+    if not _has_unique_track_vehicle(inspector):
+        remove_duplicate_subscriptions()
+        db.session.execute(
+            text(
+                "CREATE UNIQUE INDEX unique_track_vehicle "
+                "ON subscriptions (track_id, vehicle_id)"
+            )
+        )
+        db.session.commit()
+        logger.info("Created unique index 'unique_track_vehicle'")
+
+    for class_ in (Subscription, LapRecord, Vehicle):
+        table = class_.__table__
+        existing = {index["name"] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(bind=db.engine)
+                logger.info(f"Created index '{index.name}'")
+
+    if not db.session.query(LapRecordHistory.id).first():
+        # lap records scraped before the history existed start it
+        LapRecordHistory.backfill()
+        db.session.commit()
+        logger.info("Backfilled table 'lap_record_history'")
+    has_bests = (
+        db.session.query(SubscriptionBest.subscription_id).first()
+        and db.session.query(TrackClassBest.track_id).first()
+    )
+    if not has_bests and db.session.query(LapRecord.subscription_id).first():
+        # best lap tables created after lap records were scraped start empty
+        rebuild_aggregates()
+    logger.info("Finished migrating database")
+    return True
+
+
+def benchmark_queries(repeat: int = 5):
+    """
+    Prints query plan and best of repeat run times of the scheduling and
+    leaderboard queries
+    """
+    queries = {
+        # only ids, columns may be missing before migrating
+        "due subscriptions": due_subscriptions_query(datetime.utcnow())
+        .with_entities(Subscription.id)
+        .limit(1000),
+        "best lap per subscription": db.session.query(
+            LapRecord.subscription_id, func.min(LapRecord.lap_time)
+        ).group_by(LapRecord.subscription_id),
+        "best lap per track and class": db.session.query(
+            Track.id, Vehicle.class_id, func.min(LapRecord.lap_time)
+        )
+        .select_from(LapRecord)
+        .join(Subscription)
+        .join(Track)
+        .join(Vehicle)
+        .group_by(Track.id, Vehicle.class_id),
+        "tracked records": db.session.query(LapRecord).join(Player),
+    }
+    if db.engine.dialect.name == "sqlite":
+        explain = "EXPLAIN QUERY PLAN "
+    else:
+        explain = "EXPLAIN "
+    for name, query in queries.items():
+        sql = query.statement.compile(
+            db.engine, compile_kwargs={"literal_binds": True}
+        )
+        plan = db.session.execute(text(explain + str(sql))).all()
+        timings = []
+        for _ in range(repeat):
+            start = perf_counter()
+            query.all()
+            timings.append(perf_counter() - start)
+        print(f"{name}: {min(timings) * 1000:.1f} ms")
+        for row in plan:
+            print(f"    {row[-1]}")
+
+
+if __name__ == "__main__":
+    print("Before migration:")
+    benchmark_queries()
+    migrate()
+    print("After migration:")
+    benchmark_queries()
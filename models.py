@@ -1,5 +1,6 @@
+import math
 from datetime import datetime, timedelta
-from typing import List
+from typing import List, Tuple, Union
 
 from sqlalchemy import (
     BigInteger,
@@ -8,22 +9,31 @@ from sqlalchemy import (
     DateTime,
     Float,
     ForeignKey,
+    Index,
     Integer,
     SmallInteger,
     String,
+    Text,
     UniqueConstraint,
+    exists,
+    func,
+    literal,
 )
-from sqlalchemy.orm import relationship
+from sqlalchemy.orm import aliased, relationship
 
 import db
 from events import improved_record_event, new_record_event
 from logger import logger
-from scrape import LapRecordTuple
+from metrics import run_metrics
+from page_parse import LapRecordTuple
+from record_batch import LapRecordBatch
 from settings import (
+    CHURN_WINDOW_HOURS,
     HIGH_UPDATE_INTERVAL,
     LOW_UPDATE_INTERVAL,
     LOW_UPDATE_THRESHOLD,
     MID_UPDATE_INTERVAL,
+    UPDATE_REQUESTS_PER_HOUR,
 )
 
 
@@ -41,6 +51,24 @@ class Player(db.base):
         return str(self.name)
 
 
+class SteamProfile(db.base):
+    """
+    Cached Steam public profile summary
+    """
+
+    __tablename__ = "steam_profiles"
+
+    steam_id = Column(String, primary_key=True)
+    persona_name = Column(String, nullable=True)
+    avatar_url = Column(String, nullable=True)
+    fetched_at = Column(DateTime, nullable=False)
+
+    _repr_fields = ["steam_id", "persona_name", "fetched_at"]
+
+    def __str__(self):
+        return str(self.persona_name)
+
+
 class Controller(db.base):
     __tablename__ = "controllers"
 
@@ -107,7 +135,7 @@ class Vehicle(db.base):
 
     id = Column(BigInteger, primary_key=True)
     name = Column(String, nullable=False)
-    class_id = Column(String, ForeignKey("vehicle_classes.id"))
+    class_id = Column(String, ForeignKey("vehicle_classes.id"), index=True)
     ignored = Column(Boolean)
 
     class_ = relationship("VehicleClass", back_populates="vehicles")
@@ -161,8 +189,13 @@ class VehicleDetails(db.base):
 
 class Subscription(db.base):
     __tablename__ = "subscriptions"
-    __tableargs__ = tuple(
-        UniqueConstraint("track_id", "vehicle_id", name="unique_track_vehicle")
+    __table_args__ = (
+        UniqueConstraint("track_id", "vehicle_id", name="unique_track_vehicle"),
+        # due subscriptions ordered by next_update
+        Index("ix_subscriptions_next_update", "next_update", "update_interval_hours"),
+        # due subscriptions of a single update interval
+        Index("ix_subscriptions_interval", "update_interval_hours", "next_update"),
+        Index("ix_subscriptions_vehicle_id", "vehicle_id"),
     )
 
     id = Column(Integer, primary_key=True, autoincrement=True)
@@ -171,6 +204,8 @@ class Subscription(db.base):
     update_interval_hours = Column(SmallInteger, nullable=True)
     last_update = Column(DateTime, nullable=True)
     next_update = Column(DateTime, nullable=True)
+    # average new and improved records per hour, see observe_change_rate
+    change_rate = Column(Float, nullable=True)
 
     track = relationship("Track", back_populates="subscriptions")
     vehicle = relationship("Vehicle", back_populates="subscriptions")
@@ -181,48 +216,183 @@ class Subscription(db.base):
     def __str__(self):
         return f"Subscription: {self.vehicle} on {self.track}"
 
-    def update(self, lap_records: List[LapRecordTuple]):
-        current_records = {
-            lap_record.player_id: lap_record for lap_record in self.lap_records
+    def update(
+        self,
+        lap_records: Union[LapRecordBatch, List[LapRecordTuple]],
+        commit: bool = True,
+    ):
+        """
+        Upserts scraped lap records, refreshes update interval and update
+        timestamps in a single transaction
+
+        Parameters:
+        lap_records (LapRecordBatch): scraped leaderboard rows, a list of
+        LapRecordTuple is accepted as well
+        commit (bool): commit and publish record events; when False the
+        caller is responsible for both, see update_subscriptions
+
+        Returns:
+        tuple: lists of new records and of (improved record, old time) pairs
+        """
+        now = datetime.utcnow()
+        with run_metrics.timer("db_seconds_per_subscription"):
+            new_records, improved_records = self.upsert_lap_records(lap_records)
+            # the first scrape finds the whole leaderboard, which is no churn
+            if self.last_update:
+                self.observe_change_rate(
+                    len(new_records) + len(improved_records), now
+                )
+            self.refresh_update_interval()
+        self.last_update = now
+        self.next_update = self.last_update + timedelta(
+            hours=self.update_interval_hours
+        )
+        run_metrics.inc("subscriptions_updated")
+        if commit:
+            with run_metrics.timer("db_commit_seconds"):
+                db.session.commit()
+            self.publish_record_events(new_records, improved_records)
+        return new_records, improved_records
+
+    def upsert_lap_records(
+        self, lap_records: Union[LapRecordBatch, List[LapRecordTuple]]
+    ) -> Tuple[List[LapRecordTuple], List[Tuple[LapRecordTuple, int]]]:
+        if not lap_records:
+            return [], []
+        lap_records = LapRecordBatch.from_records(lap_records)
+        # steam ids are compared as integers, as stored in the batch
+        current_times = {
+            int(player_id): lap_time
+            for player_id, lap_time in db.session.query(
+                LapRecord.player_id, LapRecord.lap_time
+            ).filter(LapRecord.subscription_id == self.id)
         }
-        for record in lap_records:
-            old_record = current_records.get(record.player_id)
-            if not old_record:
-                # new lap record
-                lr = LapRecord(subscription=self, **record._asdict())
-                db.session.add(lr)
-            elif old_record.lap_time > record.lap_time:
-                old_record.update(**record)
-        db.session.commit()
-        # refresh update_interval
-        tracked_player = (
-            db.session.query(LapRecord)
-            .join(Player)
-            .filter(LapRecord.subscription == self)
-            .first()
+
+        # only changed rows are turned back into LapRecordTuple
+        new_records = []
+        improved_records = []
+        lap_times = lap_records.lap_times
+        for player_id, i in lap_records.best_per_player().items():
+            old_time = current_times.get(player_id)
+            if old_time is None:
+                new_records.append(lap_records[i])
+            elif old_time > lap_times[i]:
+                improved_records.append((lap_records[i], old_time))
+
+        changed = new_records + [record for record, _ in improved_records]
+        if changed:
+            table = LapRecord.__table__
+            statement = db.upsert(table)
+            statement = statement.on_conflict_do_update(
+                index_elements=[table.c.subscription_id, table.c.player_id],
+                set_={
+                    field: statement.excluded[field]
+                    for field in LapRecordTuple._fields
+                    if field != "player_id"
+                },
+                where=statement.excluded.lap_time < table.c.lap_time,
+            )
+            db.session.execute(
+                statement,
+                [dict(subscription_id=self.id, **r._asdict()) for r in changed],
+            )
+            # a leaderboard without records gets all of them, no players to list
+            LapRecordHistory.record(
+                self.id,
+                [r.player_id for r in changed] if current_times else None,
+                datetime.utcnow(),
+            )
+            best_record = min(changed, key=lambda record: record.lap_time)
+            SubscriptionBest.offer(self, best_record)
+            TrackClassBest.offer(self, best_record)
+        run_metrics.inc("lap_records_scraped", len(lap_records))
+        run_metrics.inc("lap_records_new", len(new_records))
+        run_metrics.inc("lap_records_improved", len(improved_records))
+        logger.debug(
+            f"Subscription {self.id}: {len(new_records)} new and "
+            f"{len(improved_records)} improved records"
+        )
+        return new_records, improved_records
+
+    def observe_change_rate(self, changes: int, now: datetime):
+        """
+        Folds changes found since the last update into change_rate; longer
+        gaps between updates weigh more, with CHURN_WINDOW_HOURS as time
+        constant
+        """
+        hours = (now - self.last_update).total_seconds() / 3600
+        if hours <= 0:
+            return
+        rate = changes / hours
+        if self.change_rate is None:
+            self.change_rate = rate
+        else:
+            weight = 1 - math.exp(-hours / CHURN_WINDOW_HOURS)
+            self.change_rate += weight * (rate - self.change_rate)
+
+    def refresh_update_interval(self):
+        records_count, tracked_count = (
+            db.session.query(
+                func.count(LapRecord.player_id), func.count(Player.steam_id)
+            )
+            .select_from(LapRecord)
+            .outerjoin(Player)
+            .filter(LapRecord.subscription_id == self.id)
+            .one()
         )
-        if tracked_player:
+        if UPDATE_REQUESTS_PER_HOUR and self.change_rate is not None:
+            # learned intervals are set by scheduling.rebalance_intervals
+            if tracked_count and self.update_interval_hours > HIGH_UPDATE_INTERVAL:
+                self.update_interval_hours = HIGH_UPDATE_INTERVAL
+            return
+        if tracked_count:
             if self.update_interval_hours != HIGH_UPDATE_INTERVAL:
                 logger.info(
                     "Found new record by tracked player. Updating update_interval_hours"
                 )
                 self.update_interval_hours = HIGH_UPDATE_INTERVAL
-        elif len(self.lap_records) > LOW_UPDATE_THRESHOLD:
+        elif records_count > LOW_UPDATE_THRESHOLD:
             if self.update_interval_hours != MID_UPDATE_INTERVAL:
                 self.update_interval_hours = MID_UPDATE_INTERVAL
         elif self.update_interval_hours != LOW_UPDATE_INTERVAL:
             self.update_interval_hours = LOW_UPDATE_INTERVAL
-        db.session.commit()
-        # refresh last_update and next_update
-        self.last_update = datetime.utcnow()
-        self.next_update = self.last_update + timedelta(
-            hours=self.update_interval_hours
+
+    def publish_record_events(
+        self,
+        new_records: List[LapRecordTuple],
+        improved_records: List[Tuple[LapRecordTuple, int]],
+    ):
+        """
+        Publishes new/improved record events for tracked players only
+        """
+        old_times = {record.player_id: t for record, t in improved_records}
+        player_ids = [record.player_id for record in new_records]
+        player_ids.extend(old_times.keys())
+        if not player_ids:
+            return
+        tracked_records = (
+            db.session.query(LapRecord)
+            .join(Player)
+            .filter(LapRecord.subscription_id == self.id)
+            .filter(LapRecord.player_id.in_(player_ids))
+            .all()
         )
-        db.session.commit()
+        for lap_record in tracked_records:
+            old_time = old_times.get(lap_record.player_id)
+            if old_time is None:
+                new_record_event.publish(lap_record)
+            else:
+                improved_record_event.publish(lap_record, old_time)
 
 
 class LapRecord(db.base):
     __tablename__ = "lap_records"
+    __table_args__ = (
+        # best lap per subscription
+        Index("ix_lap_records_subscription_lap_time", "subscription_id", "lap_time"),
+        # records of tracked players
+        Index("ix_lap_records_player_id", "player_id"),
+    )
 
     subscription_id = Column(Integer, ForeignKey("subscriptions.id"), primary_key=True)
     player_id = Column(String, ForeignKey("players.steam_id"), primary_key=True)
@@ -267,3 +437,407 @@ class LapRecord(db.base):
         seconds, millis = divmod(millis, 1000)
         minutes, seconds = divmod(seconds, 60)
         return f"{minutes:02d}:{seconds:02d}.{millis:03d}"
+
+
+def _offer_best(table, index_elements: List[str], values: dict):
+    """
+    Upserts values into a best lap table unless the stored lap is faster
+    """
+    statement = db.upsert(table).values(**values)
+    statement = statement.on_conflict_do_update(
+        index_elements=index_elements,
+        set_={
+            column: statement.excluded[column]
+            for column in values
+            if column not in index_elements
+        },
+        where=statement.excluded.lap_time < table.c.lap_time,
+    )
+    db.session.execute(statement)
+
+
+class SubscriptionBest(db.base):
+    """
+    Materialized best lap per subscription, kept up to date on write
+    """
+
+    __tablename__ = "subscription_bests"
+
+    subscription_id = Column(
+        Integer, ForeignKey("subscriptions.id"), primary_key=True
+    )
+    player_id = Column(String, nullable=False)
+    lap_time = Column(Integer, nullable=False)
+    upload_date = Column(DateTime, nullable=False)
+
+    subscription = relationship("Subscription")
+
+    _repr_fields = ["subscription_id", "player_id", "lap_time"]
+
+    @classmethod
+    def offer(cls, subscription: Subscription, record: LapRecordTuple):
+        _offer_best(
+            cls.__table__,
+            ["subscription_id"],
+            dict(
+                subscription_id=subscription.id,
+                player_id=record.player_id,
+                lap_time=record.lap_time,
+                upload_date=record.upload_date,
+            ),
+        )
+
+    @classmethod
+    def rebuild(cls):
+        ranked = (
+            db.session.query(
+                LapRecord.subscription_id,
+                LapRecord.player_id,
+                LapRecord.lap_time,
+                LapRecord.upload_date,
+                func.row_number()
+                .over(
+                    partition_by=LapRecord.subscription_id,
+                    order_by=(LapRecord.lap_time, LapRecord.upload_date),
+                )
+                .label("position"),
+            )
+        ).subquery()
+        columns = ["subscription_id", "player_id", "lap_time", "upload_date"]
+        db.session.execute(cls.__table__.delete())
+        db.session.execute(
+            cls.__table__.insert().from_select(
+                columns,
+                db.session.query(*(ranked.c[c] for c in columns))
+                .filter(ranked.c.position == 1)
+                .statement,
+            )
+        )
+
+
+class TrackClassBest(db.base):
+    """
+    Materialized best lap per track and vehicle class, kept up to date on
+    write
+    """
+
+    __tablename__ = "track_class_bests"
+
+    track_id = Column(BigInteger, ForeignKey("tracks.id"), primary_key=True)
+    class_id = Column(String, ForeignKey("vehicle_classes.id"), primary_key=True)
+    subscription_id = Column(Integer, ForeignKey("subscriptions.id"), nullable=False)
+    player_id = Column(String, nullable=False)
+    lap_time = Column(Integer, nullable=False)
+    upload_date = Column(DateTime, nullable=False)
+
+    subscription = relationship("Subscription")
+
+    _repr_fields = ["track_id", "class_id", "player_id", "lap_time"]
+
+    @classmethod
+    def offer(cls, subscription: Subscription, record: LapRecordTuple):
+        class_id = subscription.vehicle.class_id
+        # vehicles without a class have no class best, as in rebuild
+        if class_id is None:
+            return
+        _offer_best(
+            cls.__table__,
+            ["track_id", "class_id"],
+            dict(
+                track_id=subscription.track_id,
+                class_id=class_id,
+                subscription_id=subscription.id,
+                player_id=record.player_id,
+                lap_time=record.lap_time,
+                upload_date=record.upload_date,
+            ),
+        )
+
+    @classmethod
+    def rebuild(cls):
+        ranked = (
+            db.session.query(
+                Subscription.track_id,
+                Vehicle.class_id,
+                LapRecord.subscription_id,
+                LapRecord.player_id,
+                LapRecord.lap_time,
+                LapRecord.upload_date,
+                func.row_number()
+                .over(
+                    partition_by=(Subscription.track_id, Vehicle.class_id),
+                    order_by=(LapRecord.lap_time, LapRecord.upload_date),
+                )
+                .label("position"),
+            )
+            .select_from(LapRecord)
+            .join(Subscription)
+            .join(Vehicle)
+            .filter(Vehicle.class_id != None)
+        ).subquery()
+        columns = [
+            "track_id",
+            "class_id",
+            "subscription_id",
+            "player_id",
+            "lap_time",
+            "upload_date",
+        ]
+        db.session.execute(cls.__table__.delete())
+        db.session.execute(
+            cls.__table__.insert().from_select(
+                columns,
+                db.session.query(*(ranked.c[c] for c in columns))
+                .filter(ranked.c.position == 1)
+                .statement,
+            )
+        )
+
+
+# players per history insert, within the SQLite limit of 999 parameters
+HISTORY_PLAYERS_PER_INSERT = 500
+
+
+class LapRecordHistory(db.base):
+    """
+    Append-only log of every new and improved lap record as observed; one
+    row per observation, without the player name of lap_records
+    """
+
+    __tablename__ = "lap_record_history"
+    __table_args__ = (
+        # progression of a player on a leaderboard, previous laps
+        Index(
+            "ix_lap_record_history_subscription_player",
+            "subscription_id",
+            "player_id",
+            "upload_date",
+        ),
+        # progression of a player on all leaderboards
+        Index("ix_lap_record_history_player", "player_id", "observed_at"),
+        # changes since a point in time
+        Index("ix_lap_record_history_observed_at", "observed_at"),
+    )
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    subscription_id = Column(Integer, ForeignKey("subscriptions.id"), nullable=False)
+    player_id = Column(String, nullable=False)
+    lap_time = Column(Integer, nullable=False)
+    sector1 = Column(Integer)
+    sector2 = Column(Integer)
+    sector3 = Column(Integer)
+    controller_id = Column(String, nullable=True)
+    upload_date = Column(DateTime, nullable=False)
+    observed_at = Column(DateTime, nullable=False)
+
+    subscription = relationship("Subscription")
+
+    _repr_fields = ["subscription_id", "player_id", "lap_time", "upload_date"]
+
+    # columns copied from lap_records
+    _lap_record_columns = [
+        "subscription_id",
+        "player_id",
+        "lap_time",
+        "sector1",
+        "sector2",
+        "sector3",
+        "controller_id",
+        "upload_date",
+    ]
+
+    @classmethod
+    def record(
+        cls, subscription_id: int, player_ids: List[str], observed_at: datetime
+    ):
+        """
+        Appends lap records of players on a leaderboard as just upserted, or
+        all of its records if player_ids is None
+
+        Rows are copied from lap_records by INSERT ... SELECT, instead of
+        sending every record to the database a second time.
+        """
+        columns = cls._lap_record_columns
+        query = db.session.query(
+            *(getattr(LapRecord, c) for c in columns),
+            literal(observed_at, DateTime).label("observed_at"),
+        ).filter(LapRecord.subscription_id == subscription_id)
+        if player_ids is None:
+            queries = [query]
+        else:
+            queries = [
+                query.filter(
+                    LapRecord.player_id.in_(
+                        player_ids[i : i + HISTORY_PLAYERS_PER_INSERT]
+                    )
+                )
+                for i in range(0, len(player_ids), HISTORY_PLAYERS_PER_INSERT)
+            ]
+        insert = cls.__table__.insert()
+        for query in queries:
+            db.session.execute(
+                insert.from_select(columns + ["observed_at"], query.statement)
+            )
+
+    @classmethod
+    def backfill(cls):
+        """
+        Seeds the history with current lap records of players without any
+        history on their leaderboard, observed at their upload date
+        """
+        columns = cls._lap_record_columns
+        missing = (
+            db.session.query(
+                *(getattr(LapRecord, c) for c in columns),
+                LapRecord.upload_date.label("observed_at"),
+            )
+            .filter(
+                ~exists().where(
+                    (cls.subscription_id == LapRecord.subscription_id)
+                    & (cls.player_id == LapRecord.player_id)
+                )
+            )
+            .statement
+        )
+        db.session.execute(
+            cls.__table__.insert().from_select(columns + ["observed_at"], missing)
+        )
+
+    @classmethod
+    def _previous_lap_time(cls):
+        previous = aliased(cls)
+        return (
+            db.session.query(previous.lap_time)
+            .filter(previous.subscription_id == cls.subscription_id)
+            .filter(previous.player_id == cls.player_id)
+            .filter(previous.upload_date < cls.upload_date)
+            .order_by(previous.upload_date.desc())
+            .limit(1)
+            .scalar_subquery()
+        )
+
+    @classmethod
+    def progression(cls, player_id: str, subscription_id: int = None):
+        """
+        Returns (subscription id, upload date, lap time, sectors) rows of a
+        player ordered by upload date, on one or all leaderboards
+        """
+        query = db.session.query(
+            cls.subscription_id,
+            cls.upload_date,
+            cls.lap_time,
+            cls.sector1,
+            cls.sector2,
+            cls.sector3,
+        ).filter(cls.player_id == player_id)
+        if subscription_id is not None:
+            query = query.filter(cls.subscription_id == subscription_id)
+        return query.order_by(cls.subscription_id, cls.upload_date).all()
+
+    @classmethod
+    def improvements_since(
+        cls, since: datetime, subscription_id: int = None, player_id: str = None
+    ):
+        """
+        Returns history rows observed since a point in time with the lap time
+        they replaced, None for new records; the previous lap is looked up in
+        the subscription and player index
+        """
+        query = db.session.query(cls, cls._previous_lap_time().label("old_time"))
+        query = query.filter(cls.observed_at >= since)
+        if subscription_id is not None:
+            query = query.filter(cls.subscription_id == subscription_id)
+        if player_id is not None:
+            query = query.filter(cls.player_id == player_id)
+        return query.order_by(cls.observed_at, cls.id).all()
+
+
+def rebuild_aggregates():
+    """
+    Recomputes all materialized best lap tables from lap_records
+    """
+    logger.info("Started rebuilding aggregates")
+    SubscriptionBest.rebuild()
+    TrackClassBest.rebuild()
+    db.session.commit()
+    logger.info("Finished rebuilding aggregates")
+    return True
+
+
+class DiscordMessage(db.base):
+    """
+    Outbound Discord embed waiting for delivery
+    """
+
+    __tablename__ = "discord_messages"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    embed = Column(Text, nullable=False)
+    steam_id = Column(String, nullable=True)
+    created_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+    attempts = Column(SmallInteger, nullable=False, default=0)
+    # set when delivery is given up, the message is kept for inspection
+    failed_at = Column(DateTime, nullable=True)
+
+    _repr_fields = ["id", "steam_id", "created_at", "attempts", "failed_at"]
+
+    def __str__(self):
+        return f"DiscordMessage {self.id}"
+
+
+class UpdateJob(db.base):
+    """
+    Refresh of a subscription in the durable update queue, see job_queue.py
+
+    A job is pending until a run leases it, running while leased and done
+    or failed when finished; failed attempts go back to pending with backoff
+    until attempts run out. Jobs of subscriptions deactivated or refreshed
+    meanwhile are cancelled instead of claimed.
+    """
+
+    __tablename__ = "update_jobs"
+    __table_args__ = (
+        # claimable jobs in queue order
+        Index("ix_update_jobs_status_available_at", "status", "available_at"),
+        # open job of a subscription
+        Index("ix_update_jobs_subscription_status", "subscription_id", "status"),
+    )
+
+    PENDING = "pending"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+    STATUSES = (PENDING, RUNNING, DONE, FAILED, CANCELLED)
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    subscription_id = Column(Integer, ForeignKey("subscriptions.id"), nullable=False)
+    status = Column(String, nullable=False, default=PENDING)
+    attempts = Column(SmallInteger, nullable=False, default=0)
+    created_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+    # not claimed before, pushed back by retry backoff
+    available_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+    lease_owner = Column(String, nullable=True)
+    leased_until = Column(DateTime, nullable=True)
+    started_at = Column(DateTime, nullable=True)
+    finished_at = Column(DateTime, nullable=True)
+    last_error = Column(Text, nullable=True)
+
+    subscription = relationship("Subscription")
+
+    _repr_fields = ["id", "subscription_id", "status", "attempts"]
+
+    def __str__(self):
+        return f"UpdateJob {self.id} of subscription {self.subscription_id}"
+
+
+def update_subscriptions(items: List[Tuple[Subscription, LapRecordBatch]]) -> bool:
+    """
+    Updates a batch of subscriptions in a single transaction
+    """
+    changes = [s.update(lap_records, commit=False) for s, lap_records in items]
+    with run_metrics.timer("db_commit_seconds"):
+        db.session.commit()
+    for (s, _), (new_records, improved_records) in zip(items, changes):
+        s.publish_record_events(new_records, improved_records)
+    return True
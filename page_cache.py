@@ -0,0 +1,141 @@
+import hashlib
+import sqlite3
+import time
+from collections import defaultdict, namedtuple
+from typing import Dict, Tuple
+
+from logger import logger
+from settings import PAGE_CACHE_MAX_ENTRIES, PAGE_CACHE_PATH
+
+CacheEntry = namedtuple(
+    "CacheEntry", ["etag", "last_modified", "content_hash", "number_of_pages"]
+)
+
+
+class PageCache(object):
+    """
+    On-disk cache of leaderboard page validators and content hashes
+
+    Entries of a subscription are only written by commit, after its records
+    were persisted, so a crash never marks unsaved pages as unchanged
+    """
+
+    _pending: Dict[Tuple[int, int], Dict[str, CacheEntry]]
+
+    def __init__(
+        self, path: str = PAGE_CACHE_PATH, max_entries: int = PAGE_CACHE_MAX_ENTRIES
+    ):
+        self._max_entries = max_entries
+        # sharded crawler processes share the file, see main.py
+        self._connection = sqlite3.connect(path, timeout=30)
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS pages ("
+            "key TEXT PRIMARY KEY, etag TEXT, last_modified TEXT, "
+            "content_hash TEXT NOT NULL, number_of_pages INTEGER NOT NULL, "
+            "accessed_at REAL NOT NULL)"
+        )
+        self._connection.execute(
+            "CREATE INDEX IF NOT EXISTS pages_accessed_at ON pages (accessed_at)"
+        )
+        self._pending = defaultdict(dict)
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(track_id: int, vehicle_id: int, page: int, by_date: bool = False):
+        return f"{track_id}:{vehicle_id}:{page}:{int(by_date)}"
+
+    @staticmethod
+    def content_hash(content: str) -> str:
+        return hashlib.blake2b(content.encode(), digest_size=16).hexdigest()
+
+    @staticmethod
+    def conditional_headers(entry: CacheEntry) -> Dict[str, str]:
+        headers = dict()
+        if entry.etag:
+            headers["If-None-Match"] = entry.etag
+        if entry.last_modified:
+            headers["If-Modified-Since"] = entry.last_modified
+        return headers
+
+    def get(self, key: str) -> CacheEntry:
+        row = self._connection.execute(
+            "SELECT etag, last_modified, content_hash, number_of_pages "
+            "FROM pages WHERE key = ?",
+            (key,),
+        ).fetchone()
+        return CacheEntry(*row) if row else None
+
+    def store(self, track_id: int, vehicle_id: int, key: str, entry: CacheEntry):
+        self._pending[(track_id, vehicle_id)][key] = entry
+
+    def commit(self, track_id: int, vehicle_id: int):
+        entries = self._pending.pop((track_id, vehicle_id), None)
+        if not entries:
+            return
+        now = time.time()
+        try:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?, ?)",
+                [(key, *entry, now) for key, entry in entries.items()],
+            )
+            self._connection.commit()
+        except sqlite3.Error:
+            # e.g. locked by another shard; the records are saved already, the
+            # pages are only parsed again next time
+            self._connection.rollback()
+            logger.exception(
+                f"Failed to cache pages of track={track_id} vehicle={vehicle_id}"
+            )
+
+    def discard(self, track_id: int, vehicle_id: int):
+        self._pending.pop((track_id, vehicle_id), None)
+
+    def evict(self):
+        """
+        Keeps only max_entries most recently used entries
+        """
+        deleted = self._connection.execute(
+            "DELETE FROM pages WHERE key NOT IN "
+            "(SELECT key FROM pages ORDER BY accessed_at DESC LIMIT ?)",
+            (self._max_entries,),
+        ).rowcount
+        self._connection.commit()
+        if deleted:
+            logger.debug(f"Evicted {deleted} entries from page cache")
+
+    def clear(self):
+        """
+        Forgets all pages, so none of them is taken as unchanged
+        """
+        self._pending.clear()
+        self._connection.execute("DELETE FROM pages")
+        self._connection.commit()
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def close(self, evict: bool = True):
+        if self.hits or self.misses:
+            logger.info(
+                f"Page cache: {self.hits} of {self.hits + self.misses} pages "
+                f"unchanged ({self.hit_rate:.1%} hit rate)"
+            )
+        if evict:
+            self.evict()
+        self._connection.close()
+
+
+def clear_page_cache(path: str = PAGE_CACHE_PATH):
+    """
+    Clears the page cache, if enabled, after lap records were removed or the
+    database was rebuilt; cached pages would never be saved again otherwise
+    """
+    if not path:
+        return
+    cache = PageCache(path)
+    cache.clear()
+    cache.close(evict=False)
+    logger.info("Cleared page cache")
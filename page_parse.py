@@ -0,0 +1,245 @@
+import re
+from collections import namedtuple
+from html import unescape
+from typing import Callable, Dict, List
+
+import bs4
+
+from time_parse import parse_datetimes, parse_lap_times
+
+SECTORS_PATTERN = re.compile(r"Sector \d: (\d+:\d{2}\.\d{3})")
+
+LapRecordTuple = namedtuple(
+    "LapRecordTuple",
+    [
+        "player_id",
+        "player_name",
+        "lap_time",
+        "sector1",
+        "sector2",
+        "sector3",
+        "controller_id",
+        "upload_date",
+    ],
+)
+
+# is_valid is False for an invalid track and vehicle combination
+PageTuple = namedtuple("PageTuple", ["is_valid", "number_of_pages", "lap_records"])
+
+
+def _is_unknown(username: str) -> bool:
+    # rows of unknown or private players lack the other cells
+    return not username or username == "<unknown>"
+
+
+def _parse_rows(rows: List[tuple]) -> List[LapRecordTuple]:
+    """
+    Builds the lap records of a page from raw cell values of its kept rows:
+    (username, steam_id, sectors, time_text, controller_title,
+    timestamp_text). Times and dates of all rows are parsed at once.
+    """
+    lap_times = parse_lap_times([row[3] for row in rows])
+    sectors = parse_lap_times([sector for row in rows for sector in row[2]])
+    upload_dates = parse_datetimes([row[5] for row in rows])
+    return [
+        LapRecordTuple(
+            steam_id,
+            username,
+            lap_times[i],
+            *sectors[3 * i : 3 * i + 3],
+            controller_title[12],
+            upload_dates[i],
+        )
+        for i, (username, steam_id, _, _, controller_title, _) in enumerate(rows)
+    ]
+
+
+# BeautifulSoup backend
+
+
+def _get_rows_from_soup(soup: bs4.BeautifulSoup) -> List[bs4.element.Tag]:
+    """
+    Returns list of table rows from soup
+    """
+    return (
+        soup.find("table", id="leaderboard")
+        .find_all("tbody")[-1]
+        .find_all("tr")
+    )
+
+
+def _scrape_soup(soup: bs4.BeautifulSoup) -> List[LapRecordTuple]:
+    rows = []
+    for row in _get_rows_from_soup(soup):
+        user_td = row.find("td", class_="user")
+        username = user_td.get_text(strip=True)
+        if _is_unknown(username):
+            continue
+        time_td = row.find("td", class_="time")
+        sectors = SECTORS_PATTERN.findall(time_td["title"])
+        if len(sectors) != 3:
+            continue
+        rows.append(
+            (
+                username,
+                user_td["id"][5:],
+                sectors,
+                time_td.find("span", class_="time").get_text(),
+                row.find("td", class_="assists").find_all("img")[1]["title"],
+                row.find("td", class_="timestamp").get_text(),
+            )
+        )
+    return _parse_rows(rows)
+
+
+def _get_number_of_pages(soup: bs4.BeautifulSoup) -> int:
+    if soup.find("tr", class_="no_data"):
+        return 0
+    page_select = soup.find("select", id="pager_top_select_page")
+    if not page_select:
+        return 1
+    return int(page_select.find_all("option")[-1].get_text())
+
+
+def parse_page_bs4(content: str) -> PageTuple:
+    soup = bs4.BeautifulSoup(content, "html.parser")
+    if soup.find("p", class_="error"):
+        return PageTuple(False, 0, [])
+    number_of_pages = _get_number_of_pages(soup)
+    if number_of_pages == 0:
+        return PageTuple(True, 0, [])
+    return PageTuple(True, number_of_pages, _scrape_soup(soup))
+
+
+# streaming backend: only tokenizes the rows of the #leaderboard tbody
+
+
+def _class_pattern(tag: str, class_: str):
+    return re.compile(
+        rf"<{tag}\b[^>]*\bclass\s*=\s*[\"'](?:[^\"']*\s)?{class_}(?:\s[^\"']*)?[\"']",
+        re.IGNORECASE,
+    )
+
+
+ERROR_PATTERN = _class_pattern("p", "error")
+NO_DATA_PATTERN = _class_pattern("tr", "no_data")
+PAGE_SELECT_PATTERN = re.compile(
+    r"<select\b[^>]*\bid\s*=\s*[\"']pager_top_select_page[\"'][^>]*>(.*?)</select",
+    re.IGNORECASE | re.DOTALL,
+)
+OPTION_PATTERN = re.compile(r"<option\b[^>]*>(.*?)</option", re.IGNORECASE | re.DOTALL)
+TABLE_PATTERN = re.compile(
+    r"<table\b[^>]*\bid\s*=\s*[\"']leaderboard[\"'][^>]*>", re.IGNORECASE
+)
+TBODY_PATTERN = re.compile(r"<tbody\b[^>]*>", re.IGNORECASE)
+ROW_PATTERN = re.compile(r"<tr\b[^>]*>(.*?)</tr\s*>", re.IGNORECASE | re.DOTALL)
+CELL_PATTERN = re.compile(r"<td\b([^>]*)>(.*?)</td\s*>", re.IGNORECASE | re.DOTALL)
+SPAN_TIME_PATTERN = re.compile(
+    r"<span\b([^>]*)>(.*?)</span\s*>", re.IGNORECASE | re.DOTALL
+)
+IMG_PATTERN = re.compile(r"<img\b([^>]*)>", re.IGNORECASE)
+ATTRIBUTE_PATTERN = re.compile(
+    r"([^\s=/>]+)(?:\s*=\s*(?:\"([^\"]*)\"|'([^']*)'|([^\s>]+)))?"
+)
+TAG_PATTERN = re.compile(r"<[^>]*>")
+
+
+def _attributes(s: str) -> Dict[str, str]:
+    return {
+        name.lower(): unescape(double or single or bare)
+        for name, double, single, bare in ATTRIBUTE_PATTERN.findall(s)
+    }
+
+
+def _get_text(s: str, strip: bool = False) -> str:
+    parts = (unescape(part) for part in TAG_PATTERN.split(s))
+    if strip:
+        return "".join(part.strip() for part in parts)
+    return "".join(parts)
+
+
+def _scrape_rows(content: str) -> List[LapRecordTuple]:
+    table_start = TABLE_PATTERN.search(content).end()
+    table_end = content.lower().find("</table", table_start)
+    table = content[table_start:table_end]
+    tbody_start = list(TBODY_PATTERN.finditer(table))[-1].end()
+
+    rows = []
+    for row in ROW_PATTERN.finditer(table, tbody_start):
+        cells = dict()
+        for attributes, inner in CELL_PATTERN.findall(row.group(1)):
+            attributes = _attributes(attributes)
+            for class_ in attributes.get("class", "").split():
+                cells.setdefault(class_, (attributes, inner))
+
+        user_attributes, user_inner = cells["user"]
+        username = _get_text(user_inner, strip=True)
+        if _is_unknown(username):
+            continue
+        time_attributes, time_inner = cells["time"]
+        sectors = SECTORS_PATTERN.findall(time_attributes["title"])
+        if len(sectors) != 3:
+            continue
+        span_text = next(
+            _get_text(inner)
+            for attributes, inner in SPAN_TIME_PATTERN.findall(time_inner)
+            if "time" in _attributes(attributes).get("class", "").split()
+        )
+        images = IMG_PATTERN.findall(cells["assists"][1])
+        rows.append(
+            (
+                username,
+                user_attributes["id"][5:],
+                sectors,
+                span_text,
+                _attributes(images[1])["title"],
+                _get_text(cells["timestamp"][1]),
+            )
+        )
+    return _parse_rows(rows)
+
+
+def parse_page_fast(content: str) -> PageTuple:
+    if ERROR_PATTERN.search(content):
+        return PageTuple(False, 0, [])
+    if NO_DATA_PATTERN.search(content):
+        return PageTuple(True, 0, [])
+    page_select = PAGE_SELECT_PATTERN.search(content)
+    if page_select:
+        options = OPTION_PATTERN.findall(page_select.group(1))
+        number_of_pages = int(_get_text(options[-1]))
+    else:
+        number_of_pages = 1
+    return PageTuple(True, number_of_pages, _scrape_rows(content))
+
+
+PARSERS: Dict[str, Callable[[str], PageTuple]] = {
+    "bs4": parse_page_bs4,
+    "fast": parse_page_fast,
+}
+
+
+def get_parser(name: str) -> Callable[[str], PageTuple]:
+    try:
+        return PARSERS[name]
+    except KeyError:
+        raise ValueError(f"unknown parser backend '{name}'")
+
+
+if __name__ == "__main__":
+    # usage: python page_parse.py <saved leaderboard page>...
+    # checks that all backends agree and measures their parse throughput
+    import sys
+    from timeit import timeit
+
+    pages = []
+    for path in sys.argv[1:]:
+        with open(path, encoding="utf-8") as f:
+            pages.append(f.read())
+
+    expected = [parse_page_bs4(page) for page in pages]
+    for name, parser in PARSERS.items():
+        if [parser(page) for page in pages] != expected:
+            raise AssertionError(f"parser '{name}' differs from 'bs4'")
+        seconds = timeit(lambda: [parser(page) for page in pages], number=10)
+        print(f"{name}: {10 * len(pages) / seconds:.1f} pages/s")
@@ -10,7 +10,9 @@ from models import (
     Vehicle,
     VehicleClass,
     VehicleDetails,
+    rebuild_aggregates,
 )
+from page_cache import clear_page_cache
 from settings import MID_UPDATE_INTERVAL
 from static_data_api import (
     get_controllers,
@@ -25,19 +27,117 @@ from static_data_api import (
 def recreate_tables():
     logger.info("Started recreating tables")
     db.base.metadata.create_all(bind=db.engine)
+    clear_page_cache()
     logger.info("Finished recreating tables")
 
 
+def _to_records(items: pd.DataFrame) -> list:
+    # NaN is not a valid SQL value
+    return items.astype(object).where(items.notna(), None).to_dict("records")
+
+
 def populate_table(class_: db.base, items: pd.DataFrame):
+    """
+    Inserts or updates all rows of a static data table with one bulk upsert
+    """
+    table = class_.__table__
     table_name = class_.__tablename__
     logger.info(f"Adding {items['id'].count()} rows to table '{table_name}'")
-    for _, item in items.iterrows():
-        new_item = class_(**item)
-        db.session.merge(new_item)
+    if len(items):
+        statement = db.upsert(table)
+        statement = statement.on_conflict_do_update(
+            index_elements=list(table.primary_key.columns),
+            set_={
+                column: statement.excluded[column]
+                for column in items.columns
+                if column not in table.primary_key.columns
+            },
+        )
+        db.session.execute(statement, _to_records(items))
     db.session.commit()
     logger.info(f"Finished populating table '{table_name}'")
 
 
+def get_subscriptions(
+    tracks: pd.DataFrame, vehicles: pd.DataFrame, vehicle_classes: pd.DataFrame
+) -> pd.DataFrame:
+    """
+    Returns the track x vehicle cross product with an active flag for
+    subscriptions that should be updated
+    """
+    ignored_classes = vehicle_classes.loc[vehicle_classes["ignored"] == True, "id"]
+    subscriptions = tracks[["id", "ignored"]].merge(
+        vehicles[["id", "class_id", "ignored"]],
+        how="cross",
+        suffixes=("_track", "_vehicle"),
+    )
+    subscriptions["active"] = ~(
+        subscriptions["ignored_track"].astype(bool)
+        | subscriptions["ignored_vehicle"].astype(bool)
+        | subscriptions["class_id"].isin(ignored_classes)
+    )
+    return subscriptions.rename(
+        columns={"id_track": "track_id", "id_vehicle": "vehicle_id"}
+    )[["track_id", "vehicle_id", "active"]]
+
+
+def populate_subscriptions(
+    tracks: pd.DataFrame, vehicles: pd.DataFrame, vehicle_classes: pd.DataFrame
+):
+    """
+    Diffs the static data cross product against existing subscriptions:
+    inserts missing ones, activates newly unignored ones and deactivates
+    ignored or removed ones, leaving update intervals of the rest intact
+    """
+    desired = get_subscriptions(tracks, vehicles, vehicle_classes)
+    existing = pd.DataFrame(
+        db.session.query(
+            Subscription.id,
+            Subscription.track_id,
+            Subscription.vehicle_id,
+            Subscription.update_interval_hours,
+        ).all(),
+        columns=["id", "track_id", "vehicle_id", "update_interval_hours"],
+    )
+    diff = desired.merge(
+        existing, on=["track_id", "vehicle_id"], how="outer", indicator=True
+    )
+    is_active = diff["active"].fillna(False).astype(bool)
+    has_interval = diff["update_interval_hours"].notna()
+
+    new = diff[diff["_merge"] == "left_only"]
+    new = pd.DataFrame(
+        {
+            "track_id": new["track_id"].astype("int64"),
+            "vehicle_id": new["vehicle_id"].astype("int64"),
+            "update_interval_hours": new["active"]
+            .astype(bool)
+            .map({True: MID_UPDATE_INTERVAL, False: None}),
+        }
+    )
+    existing_mask = diff["_merge"] != "left_only"
+    activated = diff[existing_mask & is_active & ~has_interval]
+    deactivated = diff[existing_mask & ~is_active & has_interval]
+
+    logger.info(
+        f"Subscriptions: {len(new)} new, {len(activated)} activated, "
+        f"{len(deactivated)} deactivated"
+    )
+    db.session.bulk_insert_mappings(Subscription, _to_records(new))
+    db.session.bulk_update_mappings(
+        Subscription,
+        [
+            {"id": int(id_), "update_interval_hours": MID_UPDATE_INTERVAL}
+            for id_ in activated["id"]
+        ]
+        + [
+            {"id": int(id_), "update_interval_hours": None}
+            for id_ in deactivated["id"]
+        ],
+    )
+    db.session.commit()
+
+
 def populate_tables():
     logger.info("Started populating tables")
 
@@ -52,21 +152,8 @@ def populate_tables():
     populate_table(VehicleDetails, get_vehicle_details())
     populate_table(Controller, get_controllers())
 
-    logger.info(f"Adding {len(tracks) * len(vehicles)} rows to table 'subscriptions'")
-    ignored_classes = list(vehicle_classes[vehicle_classes["ignored"] == True]["id"])
-    for _, track in tracks.iterrows():
-        for _, vehicle in vehicles.iterrows():
-            new_subscription = Subscription(
-                track_id=track["id"], vehicle_id=vehicle["id"]
-            )
-            if not (
-                track["ignored"]
-                or vehicle["ignored"]
-                or vehicle["class_id"] in ignored_classes
-            ):
-                new_subscription.update_interval_hours = MID_UPDATE_INTERVAL
-            db.session.merge(new_subscription)
-        db.session.commit()
+    logger.info("Started populating table 'subscriptions'")
+    populate_subscriptions(tracks, vehicles, vehicle_classes)
     logger.info(f"Finished populating table 'subscriptions'")
 
     logger.info("Finished populating tables")
@@ -74,5 +161,10 @@ def populate_tables():
 
 
 if __name__ == "__main__":
-    recreate_tables()
-    populate_tables()
+    import sys
+
+    # "python rebuild_db.py aggregates" only recomputes materialized tables
+    if sys.argv[1:] != ["aggregates"]:
+        recreate_tables()
+        populate_tables()
+    rebuild_aggregates()
@@ -0,0 +1,154 @@
+import sys
+from array import array
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, Iterator, List, Sequence, Union
+
+from page_parse import LapRecordTuple
+
+EPOCH = datetime(1970, 1, 1)
+
+
+class LapRecordBatch(object):
+    """
+    Scraped lap records as columns: int64 steam ids, int32 times, uint32
+    upload dates in epoch seconds and interned player names and controllers
+
+    A row costs about 32 bytes plus two shared string references, instead of
+    a namedtuple, two strings, four ints and a datetime of its own. Rows are
+    turned back into LapRecordTuple only when indexed or iterated.
+    """
+
+    __slots__ = (
+        "player_ids",
+        "player_names",
+        "lap_times",
+        "sector1",
+        "sector2",
+        "sector3",
+        "controller_ids",
+        "upload_dates",
+    )
+
+    def __init__(self):
+        self.player_ids = array("q")
+        self.player_names: List[str] = []
+        self.lap_times = array("i")
+        self.sector1 = array("i")
+        self.sector2 = array("i")
+        self.sector3 = array("i")
+        self.controller_ids: List[str] = []
+        self.upload_dates = array("I")
+
+    @classmethod
+    def from_records(cls, lap_records: Iterable[LapRecordTuple]):
+        if isinstance(lap_records, cls):
+            return lap_records
+        batch = cls()
+        for record in lap_records:
+            batch.append(record)
+        return batch
+
+    @classmethod
+    def concat(cls, batches: Sequence["LapRecordBatch"]):
+        """
+        Joins batches by copying their packed columns, without creating a
+        Python object per row
+        """
+        if len(batches) == 1:
+            return batches[0]
+        batch = cls()
+        for other in batches:
+            for name in cls.__slots__:
+                getattr(batch, name).extend(getattr(other, name))
+        return batch
+
+    def append(self, record: LapRecordTuple):
+        self.player_ids.append(int(record.player_id))
+        self.player_names.append(sys.intern(record.player_name))
+        self.lap_times.append(record.lap_time)
+        self.sector1.append(record.sector1)
+        self.sector2.append(record.sector2)
+        self.sector3.append(record.sector3)
+        self.controller_ids.append(
+            record.controller_id and sys.intern(record.controller_id)
+        )
+        self.upload_dates.append(
+            (record.upload_date - EPOCH) // timedelta(seconds=1)
+        )
+
+    def __len__(self):
+        return len(self.lap_times)
+
+    def __getitem__(
+        self, i: Union[int, slice]
+    ) -> Union[LapRecordTuple, "LapRecordBatch"]:
+        # slices stay columnar
+        if isinstance(i, slice):
+            batch = LapRecordBatch()
+            for name in self.__slots__:
+                setattr(batch, name, getattr(self, name)[i])
+            return batch
+        return LapRecordTuple(
+            str(self.player_ids[i]),
+            self.player_names[i],
+            self.lap_times[i],
+            self.sector1[i],
+            self.sector2[i],
+            self.sector3[i],
+            self.controller_ids[i],
+            EPOCH + timedelta(seconds=self.upload_dates[i]),
+        )
+
+    def __iter__(self) -> Iterator[LapRecordTuple]:
+        for i in range(len(self)):
+            yield self[i]
+
+    def __eq__(self, other):
+        if not isinstance(other, LapRecordBatch):
+            return NotImplemented
+        return all(
+            getattr(self, name) == getattr(other, name) for name in self.__slots__
+        )
+
+    def __repr__(self):
+        return f"<LapRecordBatch of {len(self)} records>"
+
+    def best_per_player(self) -> Dict[int, int]:
+        """
+        Returns the row of the fastest lap of every player; a player can show
+        up twice if the leaderboard shifts between pages
+        """
+        best = dict()
+        lap_times = self.lap_times
+        for i, player_id in enumerate(self.player_ids):
+            j = best.get(player_id)
+            if j is None or lap_times[j] > lap_times[i]:
+                best[player_id] = i
+        return best
+
+
+if __name__ == "__main__":
+    # compares the memory held by parsed pages as namedtuples and as a batch
+    import tracemalloc
+
+    from benchmarks.generator import LeaderboardGenerator, generate_pages
+    from page_parse import parse_page_fast
+
+    generator = LeaderboardGenerator(records_per_leaderboard=5000)
+    pages = list(generate_pages(generator, 1000).values())
+
+    tracemalloc.start()
+    parsed = [parse_page_fast(page).lap_records for page in pages]
+    list_bytes = tracemalloc.get_traced_memory()[0]
+    batch = LapRecordBatch.concat(
+        [LapRecordBatch.from_records(records) for records in parsed]
+    )
+    if list(batch) != [record for records in parsed for record in records]:
+        raise AssertionError("batch differs from the parsed records")
+    del parsed
+    batch_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    print(
+        f"{len(batch)} records: {list_bytes / len(batch):.0f} B/record as "
+        f"namedtuples, {batch_bytes / len(batch):.0f} B/record as a batch"
+    )
@@ -0,0 +1,153 @@
+import math
+from datetime import timedelta
+from typing import Sequence
+
+import numpy as np
+from sqlalchemy import func
+
+import db
+from logger import logger
+from models import LapRecord, Player, Subscription
+from settings import (
+    HIGH_UPDATE_INTERVAL,
+    LOW_UPDATE_INTERVAL,
+    UPDATE_REQUESTS_PER_HOUR,
+)
+
+# leaderboard rows per page, a subscription update costs one request per page
+ROWS_PER_PAGE = 100
+
+
+def solve_intervals(
+    rates: Sequence[float],
+    costs: Sequence[float],
+    tracked: Sequence[bool],
+    budget: float,
+    min_hours: float = HIGH_UPDATE_INTERVAL,
+    max_hours: float = LOW_UPDATE_INTERVAL,
+) -> np.ndarray:
+    """
+    Returns update intervals in hours minimizing the expected time until a
+    change is found while spending at most budget requests per hour
+
+    Minimizing sum(rate * T / 2) subject to sum(cost / T) <= budget gives
+    T = k * sqrt(cost / rate). Intervals are clamped to min_hours and
+    max_hours, tracked subscriptions never wait longer than min_hours and
+    k is found by bisection on the clamped request rate. If even the longest
+    intervals exceed the budget, those are returned.
+
+    Parameters:
+    rates (Sequence[float]): changes per hour of each subscription
+    costs (Sequence[float]): requests per update of each subscription
+    tracked (Sequence[bool]): subscriptions with records of tracked players
+    budget (float): requests per hour
+
+    Returns:
+    np.ndarray: interval hours of each subscription
+    """
+    rates = np.asarray(rates, dtype=float)
+    costs = np.asarray(costs, dtype=float)
+    upper = np.where(np.asarray(tracked, dtype=bool), min_hours, max_hours)
+    with np.errstate(divide="ignore"):
+        # dead leaderboards get an infinite shape and end up at max_hours
+        shape = np.sqrt(costs / rates)
+
+    def intervals(k: float) -> np.ndarray:
+        return np.clip(k * shape, min_hours, upper)
+
+    def requests(k: float) -> float:
+        return float((costs / intervals(k)).sum())
+
+    low, high = 1e-6, 1e6
+    if requests(low) <= budget:
+        return intervals(low)
+    if requests(high) > budget:
+        return intervals(high)
+    for _ in range(64):
+        middle = math.sqrt(low * high)
+        if requests(middle) > budget:
+            low = middle
+        else:
+            high = middle
+    return intervals(high)
+
+
+def rebalance_intervals(budget: float = UPDATE_REQUESTS_PER_HOUR) -> dict:
+    """
+    Spreads the request budget over active subscriptions by their learned
+    change rate; subscriptions without one keep their interval and their
+    requests are taken from the budget first
+
+    Returns:
+    dict: requests per hour and mean hours until a change is found
+    """
+    rows = (
+        db.session.query(
+            Subscription.id,
+            Subscription.update_interval_hours,
+            Subscription.last_update,
+            Subscription.change_rate,
+            func.count(LapRecord.player_id),
+            func.count(Player.steam_id),
+        )
+        .outerjoin(LapRecord, LapRecord.subscription_id == Subscription.id)
+        .outerjoin(Player)
+        .filter(Subscription.update_interval_hours != None)
+        .group_by(Subscription.id)
+        .all()
+    )
+    learned = [row for row in rows if row[3] is not None]
+    fixed_requests = sum(
+        max(1, math.ceil(row[4] / ROWS_PER_PAGE)) / row[1]
+        for row in rows
+        if row[3] is None
+    )
+    if not learned:
+        return {"requests_per_hour": fixed_requests, "expected_delay_hours": None}
+
+    rates = np.array([row[3] for row in learned])
+    costs = np.array([max(1, math.ceil(row[4] / ROWS_PER_PAGE)) for row in learned])
+    hours = solve_intervals(
+        rates, costs, [row[5] > 0 for row in learned], budget - fixed_requests
+    )
+    # interval hours are whole, rounding up keeps within the budget
+    hours = np.ceil(hours).astype(int)
+
+    mappings = []
+    for (id_, interval, last_update, *_), new_interval in zip(learned, hours):
+        if new_interval == interval:
+            continue
+        mapping = {"id": id_, "update_interval_hours": int(new_interval)}
+        if last_update:
+            mapping["next_update"] = last_update + timedelta(hours=int(new_interval))
+        mappings.append(mapping)
+    db.session.bulk_update_mappings(Subscription, mappings)
+    db.session.commit()
+
+    summary = {
+        "requests_per_hour": fixed_requests + float((costs / hours).sum()),
+        "expected_delay_hours": (
+            float((rates * hours).sum() / 2 / rates.sum()) if rates.sum() else None
+        ),
+    }
+    if summary["requests_per_hour"] > budget:
+        logger.warning(
+            f"Update intervals need {summary['requests_per_hour']:.0f} requests "
+            f"per hour, over the budget of {budget:.0f}"
+        )
+    logger.info(
+        f"Rebalanced {len(mappings)} of {len(learned)} learned update "
+        f"intervals: {summary}"
+    )
+    return summary
+
+
+if __name__ == "__main__":
+    import sys
+
+    # usage: python scheduling.py [requests per hour]
+    print(
+        rebalance_intervals(
+            float(sys.argv[1]) if sys.argv[1:] else UPDATE_REQUESTS_PER_HOUR
+        )
+    )
@@ -1,135 +1,251 @@
 import asyncio
-import re
-from collections import namedtuple
-from datetime import datetime
-from typing import List
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime, timedelta
 
 import aiohttp
-import bs4
 
+from crawler import CrawlScheduler, FetchResult, read_response
 from logger import logger
-from settings import DATASOURCE_URL
-from time_parse import parse_datetime, parse_lap_time
-from utils import flatten_list
-
-SECTORS_PATTERN = r"Sector \d: (\d+:\d{2}\.\d{3})"
-
-LapRecordTuple = namedtuple(
-    "LapRecordTuple",
-    [
-        "player_id",
-        "player_name",
-        "lap_time",
-        "sector1",
-        "sector2",
-        "sector3",
-        "controller_id",
-        "upload_date",
-    ],
+from metrics import run_metrics
+from page_cache import CacheEntry, PageCache
+from page_parse import PageTuple, get_parser
+from record_batch import LapRecordBatch
+from settings import (
+    DATASOURCE_URL,
+    DATASOURCE_URL_BY_DATE,
+    INCREMENTAL_OVERLAP_HOURS,
+    PARSE_EXECUTOR,
+    PARSE_WORKERS,
+    SCRAPE_PARSER,
 )
 
+parse_page = get_parser(SCRAPE_PARSER)
+
 request_id = 0
 
 
-async def _prepare_soup(
-    http_session, track_id: int, vehicle_id: int, page: int = 1,
-) -> bs4.BeautifulSoup:
+def create_parse_executor() -> Executor:
+    """
+    Returns executor for page parsing configured by PARSE_EXECUTOR and
+    PARSE_WORKERS, or None to parse inside the event loop
     """
-    Request records page and prepare BeautifulSoup
+    if PARSE_WORKERS <= 0:
+        return None
+    if PARSE_EXECUTOR == "thread":
+        return ThreadPoolExecutor(max_workers=PARSE_WORKERS)
+    return ProcessPoolExecutor(max_workers=PARSE_WORKERS)
+
+
+async def _fetch_page(
+    http_session,
+    track_id: int,
+    vehicle_id: int,
+    page: int = 1,
+    scheduler: CrawlScheduler = None,
+    by_date: bool = False,
+    headers: dict = None,
+) -> FetchResult:
     """
-    url = DATASOURCE_URL.format(
+    Request records page
+    """
+    url_template = DATASOURCE_URL_BY_DATE if by_date else DATASOURCE_URL
+    url = url_template.format(
         track_id=track_id, vehicle_id=vehicle_id, page=page
     )
     global request_id
     request_id += 1
     id_ = request_id
     logger.debug(f"SENT request {id_}")
-    response = await http_session.get(url)
-    content = await response.text()
+    # latency includes waiting for a crawl slot and retries
+    with run_metrics.timer("request_seconds"):
+        if scheduler:
+            response = await scheduler.fetch(http_session, url, headers)
+        else:
+            async with http_session.get(url, headers=headers) as r:
+                response = await read_response(r)
     logger.debug(f"RCVD request {id_}")
-    soup = bs4.BeautifulSoup(content, "html.parser")
-    return soup
+    run_metrics.inc("requests")
+    run_metrics.inc("response_bytes", response.size)
+    return response
 
 
-def _get_rows_from_soup(soup: bs4.BeautifulSoup) -> List[bs4.element.Tag]:
+async def _request_and_parse_page(
+    http_session,
+    track_id: int,
+    vehicle_id: int,
+    page: int = 1,
+    scheduler: CrawlScheduler = None,
+    by_date: bool = False,
+    executor: Executor = None,
+    cache: PageCache = None,
+) -> PageTuple:
     """
-    Returns list of table rows from soup
+    Request and parse records page; pages unchanged since they were cached
+    are not parsed and return no records
     """
-    return (
-        soup.find("table", id="leaderboard")
-        .find_all("tbody")[-1]
-        .find_all("tr")
+    cache_key = PageCache.key(track_id, vehicle_id, page, by_date)
+    entry = cache.get(cache_key) if cache else None
+    headers = PageCache.conditional_headers(entry) if entry else None
+    response = await _fetch_page(
+        http_session, track_id, vehicle_id, page, scheduler, by_date, headers
     )
+    if cache:
+        if entry and response.status == 304:
+            content_hash = entry.content_hash
+        else:
+            content_hash = PageCache.content_hash(response.content)
+        if entry and entry.content_hash == content_hash:
+            cache.hits += 1
+            cache.store(track_id, vehicle_id, cache_key, entry)
+            return PageTuple(True, entry.number_of_pages, [])
+        cache.misses += 1
 
-
-async def _request_and_scrape_soup(
-    http_session, track_id: int, vehicle_id: int, page: int = 1
-) -> List[LapRecordTuple]:
-    soup = await _prepare_soup(http_session, track_id, vehicle_id, page)
-    lap_records = await _scrape_soup(soup)
-    return lap_records
-
-
-async def _scrape_soup(soup: bs4.BeautifulSoup) -> List[LapRecordTuple]:
-    lap_records = []
-    rows = _get_rows_from_soup(soup)
-    for row in rows:
-        user_td = row.find("td", class_="user")
-        username = user_td.get_text(strip=True)
-        if not username or username == "<unknown>":
-            continue
-        time_td = row.find("td", class_="time")
-        sectors = tuple(
-            map(parse_lap_time, re.findall(SECTORS_PATTERN, time_td["title"]))
-        )
-        if not sectors or len(sectors) != 3:
-            continue
-        lap_time = parse_lap_time(
-            time_td.find("span", class_="time").get_text()
-        )
-        steam_id = user_td["id"][5:]
-        assists_td = row.find("td", class_="assists")
-        controller = assists_td.find_all("img")[1]["title"][12]
-        upload_date = parse_datetime(
-            row.find("td", class_="timestamp").get_text()
-        )
-        lap_records.append(
-            LapRecordTuple(
-                steam_id, username, lap_time, *sectors, controller, upload_date
+    with run_metrics.timer("parse_seconds"):
+        if executor:
+            loop = asyncio.get_running_loop()
+            page = await loop.run_in_executor(
+                executor, parse_page, response.content
             )
+        else:
+            page = parse_page(response.content)
+    run_metrics.inc("pages_parsed")
+    if not page.is_valid:
+        raise ValueError("invalid track_id and vehicle_id combination")
+    if cache:
+        cache.store(
+            track_id,
+            vehicle_id,
+            cache_key,
+            CacheEntry(
+                response.headers.get("ETag"),
+                response.headers.get("Last-Modified"),
+                content_hash,
+                page.number_of_pages,
+            ),
         )
-    return lap_records
+    return page
+
+
+async def _request_and_scrape_page(
+    http_session,
+    track_id: int,
+    vehicle_id: int,
+    page: int = 1,
+    scheduler: CrawlScheduler = None,
+    executor: Executor = None,
+    cache: PageCache = None,
+) -> LapRecordBatch:
+    page = await _request_and_parse_page(
+        http_session,
+        track_id,
+        vehicle_id,
+        page,
+        scheduler,
+        executor=executor,
+        cache=cache,
+    )
+    return LapRecordBatch.from_records(page.lap_records)
+
 
+async def _scrape_lap_records_since(
+    http_session: aiohttp.ClientSession,
+    track_id: int,
+    vehicle_id: int,
+    since: datetime,
+    scheduler: CrawlScheduler = None,
+    executor: Executor = None,
+    cache: PageCache = None,
+) -> LapRecordBatch:
+    """
+    Walks the newest-first leaderboard page by page and stops at the first
+    page holding a record uploaded before the previous update
+    """
+    # upload dates are in the server's timezone with minute resolution
+    cutoff = since - timedelta(hours=INCREMENTAL_OVERLAP_HOURS)
+    results = []
+    page_n = 0
+    number_of_pages = 1
+    while page_n < number_of_pages:
+        page_n += 1
+        page = await _request_and_parse_page(
+            http_session,
+            track_id,
+            vehicle_id,
+            page_n,
+            scheduler,
+            by_date=True,
+            executor=executor,
+            cache=cache,
+        )
+        if page_n == 1:
+            number_of_pages = page.number_of_pages
+        if not page.lap_records:
+            # an unchanged newest-first page means nothing newer was uploaded
+            break
+        results.append(LapRecordBatch.from_records(page.lap_records))
+        if any(record.upload_date < cutoff for record in page.lap_records):
+            break
 
-def _get_number_of_pages(soup: bs4.BeautifulSoup) -> int:
-    if soup.find("tr", class_="no_data"):
-        return 0
-    page_select = soup.find("select", id="pager_top_select_page")
-    if not page_select:
-        return 1
-    return int(page_select.find_all("option")[-1].get_text())
+    results = LapRecordBatch.concat(results)
+    logger.debug(
+        f"Found {len(results)} records since {since} for track={track_id} and "
+        f"vehicle={vehicle_id} in {page_n}/{number_of_pages} pages"
+    )
+    return results
 
 
 async def scrape_lap_records(
-    http_session: aiohttp.ClientSession, track_id: int, vehicle_id: int
-) -> List[LapRecordTuple]:
-    first_soup = await _prepare_soup(http_session, track_id, vehicle_id)
-    if first_soup.find("p", class_="error"):
-        raise ValueError("invalid track_id and vehicle_id combination")
+    http_session: aiohttp.ClientSession,
+    track_id: int,
+    vehicle_id: int,
+    scheduler: CrawlScheduler = None,
+    since: datetime = None,
+    executor: Executor = None,
+    cache: PageCache = None,
+) -> LapRecordBatch:
+    """
+    Scrapes every page of a leaderboard, or only pages with records newer
+    than since if a newest-first DATASOURCE_URL_BY_DATE is configured;
+    with a cache, records of unchanged pages are left out
+    """
+    if since and DATASOURCE_URL_BY_DATE:
+        return await _scrape_lap_records_since(
+            http_session, track_id, vehicle_id, since, scheduler, executor, cache
+        )
 
-    number_of_pages = _get_number_of_pages(first_soup)
-    if number_of_pages == 0:
-        logger.debug()
-        return []
+    first_page = await _request_and_parse_page(
+        http_session,
+        track_id,
+        vehicle_id,
+        scheduler=scheduler,
+        executor=executor,
+        cache=cache,
+    )
+    if first_page.number_of_pages == 0:
+        logger.debug(
+            f"Found no records for track={track_id} and vehicle={vehicle_id}"
+        )
+        return LapRecordBatch()
 
     tasks = []
-    for page_n in range(2, number_of_pages + 1):
+    for page_n in range(2, first_page.number_of_pages + 1):
         tasks.append(
-            _request_and_scrape_soup(http_session, track_id, vehicle_id, page_n)
+            _request_and_scrape_page(
+                http_session,
+                track_id,
+                vehicle_id,
+                page_n,
+                scheduler,
+                executor,
+                cache,
+            )
         )
-    tasks.append(_scrape_soup(first_soup))
 
-    results = flatten_list(await asyncio.gather(*tasks))
+    # pages are held as packed columns until persisted
+    results = LapRecordBatch.concat(
+        await asyncio.gather(*tasks)
+        + [LapRecordBatch.from_records(first_page.lap_records)]
+    )
     logger.debug(
         f"Found {len(results)} records for track={track_id} and vehicle={vehicle_id}"
     )
@@ -142,6 +258,6 @@ if __name__ == "__main__":
     async def test_func(track_id, vehicle_id):
         async with aiohttp.ClientSession(raise_for_status=True) as client:
             result = await scrape_lap_records(client, track_id, vehicle_id)
-        pprint(result[:5])
+        pprint(list(result[:5]))
 
     asyncio.run(test_func(track_id=3878349996, vehicle_id=1934199723))
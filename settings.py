@@ -12,14 +12,65 @@ LOW_UPDATE_INTERVAL = int(getenv("LOW_UPDATE_INTERVAL"))
 MID_UPDATE_INTERVAL = int(getenv("MID_UPDATE_INTERVAL"))
 HIGH_UPDATE_INTERVAL = int(getenv("HIGH_UPDATE_INTERVAL"))
 
+# request budget of adaptive scheduling, 0 keeps the threshold based intervals
+UPDATE_REQUESTS_PER_HOUR = float(getenv("UPDATE_REQUESTS_PER_HOUR", default=0))
+# time constant of the per-subscription change rate average
+CHURN_WINDOW_HOURS = float(getenv("CHURN_WINDOW_HOURS", default=168))
+
 DB_CONNECT_STR = getenv("DB_CONNECT_STR")
 DATASOURCE_URL = getenv("DATASOURCE_URL")
+# optional newest-first variant of DATASOURCE_URL, enables incremental scraping
+DATASOURCE_URL_BY_DATE = getenv("DATASOURCE_URL_BY_DATE")
+INCREMENTAL_OVERLAP_HOURS = int(getenv("INCREMENTAL_OVERLAP_HOURS", default=24))
+# leaderboard page parser backend, see page_parse.PARSERS
+SCRAPE_PARSER = getenv("SCRAPE_PARSER", default="fast")
+# pages are parsed in a pool of "process" or "thread" workers, 0 parses inline
+PARSE_EXECUTOR = getenv("PARSE_EXECUTOR", default="process")
+PARSE_WORKERS = int(getenv("PARSE_WORKERS", default=0))
+
+CRAWL_MAX_CONCURRENCY = int(getenv("CRAWL_MAX_CONCURRENCY", default=32))
+CRAWL_MAX_PER_HOST = int(getenv("CRAWL_MAX_PER_HOST", default=16))
+CRAWL_REQUESTS_PER_SECOND = float(getenv("CRAWL_REQUESTS_PER_SECOND", default=20))
+CRAWL_BURST = int(getenv("CRAWL_BURST", default=20))
+HTTP_TIMEOUT_SECONDS = float(getenv("HTTP_TIMEOUT_SECONDS", default=30))
+HTTP_RETRIES = int(getenv("HTTP_RETRIES", default=3))
+HTTP_BACKOFF_SECONDS = float(getenv("HTTP_BACKOFF_SECONDS", default=1))
+CRAWL_QUEUE_SIZE = int(getenv("CRAWL_QUEUE_SIZE", default=64))
+PERSIST_BATCH_SIZE = int(getenv("PERSIST_BATCH_SIZE", default=16))
+# crawler processes of main.py, subscriptions are sharded by id between them
+UPDATE_WORKERS = int(getenv("UPDATE_WORKERS", default=1))
+# durable update queue: lease renewed while a run is alive, retry backoff
+# doubling per attempt, finished jobs kept for inspection
+UPDATE_JOB_LEASE_SECONDS = int(getenv("UPDATE_JOB_LEASE_SECONDS", default=300))
+UPDATE_JOB_MAX_ATTEMPTS = int(getenv("UPDATE_JOB_MAX_ATTEMPTS", default=5))
+UPDATE_JOB_BACKOFF_SECONDS = int(getenv("UPDATE_JOB_BACKOFF_SECONDS", default=300))
+UPDATE_JOB_RETENTION_HOURS = int(getenv("UPDATE_JOB_RETENTION_HOURS", default=168))
+# max observer calls in flight per observer before backpressure kicks in
+EVENT_MAX_PENDING = int(getenv("EVENT_MAX_PENDING", default=100))
+
+# local store of page validators and hashes, empty disables the page cache
+PAGE_CACHE_PATH = getenv("PAGE_CACHE_PATH", default="page_cache.sqlite")
+PAGE_CACHE_MAX_ENTRIES = int(getenv("PAGE_CACHE_MAX_ENTRIES", default=500000))
+
+# per-run JSON report and Prometheus textfile of update metrics, empty disables
+METRICS_REPORT_PATH = getenv("METRICS_REPORT_PATH", default="")
+METRICS_PROMETHEUS_PATH = getenv("METRICS_PROMETHEUS_PATH", default="")
+# profiles update runs with "cprofile" or "pyinstrument", empty disables
+PROFILER = getenv("PROFILER", default="")
+PROFILE_PATH = getenv("PROFILE_PATH", default="update.prof")
 
 G_SHEETS_SHEET = getenv("G_SHEETS_SHEET")
 G_SHEETS_SCOPE = getenv("G_SHEETS_SCOPE")
 G_SHEETS_TOKEN = getenv("G_SHEETS_TOKEN")
 
 DISCORD_WEBHOOK = getenv("DISCORD_WEBHOOK")
+DISCORD_POLL_SECONDS = float(getenv("DISCORD_POLL_SECONDS", default=5))
+# failed deliveries of a message before it is given up
+DISCORD_MAX_ATTEMPTS = int(getenv("DISCORD_MAX_ATTEMPTS", default=5))
 
 STEAM_API_KEY = getenv("STEAM_API_KEY")
-STEAM_API_URL = getenv("STEAM_API_URL")
+STEAM_API_URL = getenv("STEAM_API_URL", default="http://api.steampowered.com")
+STEAM_CACHE_TTL_SECONDS = int(getenv("STEAM_CACHE_TTL_SECONDS", default=86400))
+STEAM_CACHE_SIZE = int(getenv("STEAM_CACHE_SIZE", default=10000))
+# also keep fetched profiles in the steam_profiles table
+STEAM_PERSIST_PROFILES = getenv("STEAM_PERSIST_PROFILES", default="").lower() == "true"
@@ -1,13 +1,194 @@
+import asyncio
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from time import monotonic
+from typing import Dict, Iterable, List
+
+import aiohttp
 import requests
 
-from settings import STEAM_API_KEY
+import db
+from logger import logger
+from models import SteamProfile
+from settings import (
+    STEAM_API_KEY,
+    STEAM_API_URL,
+    STEAM_CACHE_SIZE,
+    STEAM_CACHE_TTL_SECONDS,
+    STEAM_PERSIST_PROFILES,
+)
+
+# GetPlayerSummaries accepts up to 100 comma separated steamids
+MAX_STEAM_IDS = 100
+# how long concurrent async lookups are collected into one request
+BATCH_DELAY_SECONDS = 0.05
+
+
+def _summaries_url(steam_ids: List[str]) -> str:
+    return (
+        f"{STEAM_API_URL}/ISteamUser/GetPlayerSummaries/v0002/"
+        f"?key={STEAM_API_KEY}&steamids={','.join(steam_ids)}"
+    )
+
+
+def _chunks(steam_ids: List[str]) -> Iterable[List[str]]:
+    for i in range(0, len(steam_ids), MAX_STEAM_IDS):
+        yield steam_ids[i : i + MAX_STEAM_IDS]
+
+
+class SteamProfileService(object):
+    """
+    Steam player summaries behind a TTL+LRU cache, optionally persisted in
+    steam_profiles; concurrent async lookups are coalesced into batches of
+    up to MAX_STEAM_IDS per request
+    """
+
+    def __init__(
+        self,
+        ttl_seconds: int = STEAM_CACHE_TTL_SECONDS,
+        max_size: int = STEAM_CACHE_SIZE,
+        persist: bool = STEAM_PERSIST_PROFILES,
+    ):
+        self._ttl_seconds = ttl_seconds
+        self._max_size = max_size
+        self._persist = persist
+        self._cache = OrderedDict()
+        self._waiting = dict()
+        self._flush_handle = None
+
+    def _get_cached(self, steam_id: str):
+        item = self._cache.get(steam_id)
+        if item is None:
+            return None
+        expires_at, summary = item
+        if expires_at < monotonic():
+            del self._cache[steam_id]
+            return None
+        self._cache.move_to_end(steam_id)
+        return item
+
+    def _put(self, summaries: Dict[str, dict], ttl_seconds: float = None):
+        expires_at = monotonic() + (ttl_seconds or self._ttl_seconds)
+        for steam_id, summary in summaries.items():
+            self._cache[steam_id] = (expires_at, summary)
+            self._cache.move_to_end(steam_id)
+        while len(self._cache) > self._max_size:
+            self._cache.popitem(last=False)
+
+    def _from_cache(self, steam_ids: List[str]) -> Dict[str, dict]:
+        found = dict()
+        for steam_id in steam_ids:
+            item = self._get_cached(steam_id)
+            if item:
+                found[steam_id] = item[1]
+        missing = [steam_id for steam_id in steam_ids if steam_id not in found]
+        if self._persist and missing:
+            fresh_after = datetime.utcnow() - timedelta(seconds=self._ttl_seconds)
+            for profile in (
+                db.session.query(SteamProfile)
+                .filter(SteamProfile.steam_id.in_(missing))
+                .filter(SteamProfile.fetched_at > fresh_after)
+            ):
+                summary = {
+                    "steamid": profile.steam_id,
+                    "personaname": profile.persona_name,
+                    "avatarfull": profile.avatar_url,
+                }
+                age = (datetime.utcnow() - profile.fetched_at).total_seconds()
+                self._put({profile.steam_id: summary}, self._ttl_seconds - age)
+                found[profile.steam_id] = summary
+        return found
+
+    def _store(self, steam_ids: List[str], players: List[dict]) -> Dict[str, dict]:
+        # ids missing from the response are private or invalid, cache them too
+        summaries = {steam_id: None for steam_id in steam_ids}
+        summaries.update({player["steamid"]: player for player in players})
+        self._put(summaries)
+        if self._persist and players:
+            now = datetime.utcnow()
+            for player in players:
+                db.session.merge(
+                    SteamProfile(
+                        steam_id=player["steamid"],
+                        persona_name=player.get("personaname"),
+                        avatar_url=player.get("avatarfull"),
+                        fetched_at=now,
+                    )
+                )
+            db.session.commit()
+        return summaries
+
+    def get_summaries(self, steam_ids: Iterable[str]) -> Dict[str, dict]:
+        steam_ids = list(dict.fromkeys(steam_ids))
+        summaries = self._from_cache(steam_ids)
+        missing = [steam_id for steam_id in steam_ids if steam_id not in summaries]
+        for chunk in _chunks(missing):
+            response = requests.get(_summaries_url(chunk))
+            if response.status_code != 200:
+                continue
+            players = response.json()["response"]["players"]
+            summaries.update(self._store(chunk, players))
+        return summaries
+
+    async def _fetch_batch(self, batch: Dict[str, asyncio.Future]):
+        steam_ids = list(batch.keys())
+        try:
+            async with aiohttp.ClientSession(raise_for_status=True) as session:
+                async with session.get(_summaries_url(steam_ids)) as response:
+                    players = (await response.json())["response"]["players"]
+            summaries = self._store(steam_ids, players)
+        except Exception as e:
+            logger.warning(f"Steam profile lookup failed: {e!r}")
+            summaries = dict()
+        for steam_id, future in batch.items():
+            if not future.done():
+                future.set_result(summaries.get(steam_id))
+
+    def _flush(self):
+        if self._flush_handle:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        loop = asyncio.get_running_loop()
+        while self._waiting:
+            steam_ids = list(self._waiting.keys())[:MAX_STEAM_IDS]
+            batch = {steam_id: self._waiting.pop(steam_id) for steam_id in steam_ids}
+            loop.create_task(self._fetch_batch(batch))
+
+    async def get_summaries_async(self, steam_ids: Iterable[str]) -> Dict[str, dict]:
+        steam_ids = list(dict.fromkeys(steam_ids))
+        summaries = self._from_cache(steam_ids)
+        loop = asyncio.get_running_loop()
+        futures = dict()
+        for steam_id in steam_ids:
+            if steam_id in summaries:
+                continue
+            future = self._waiting.get(steam_id)
+            if future is None:
+                future = loop.create_future()
+                self._waiting[steam_id] = future
+            futures[steam_id] = future
+        if len(self._waiting) >= MAX_STEAM_IDS:
+            self._flush()
+        elif self._waiting and not self._flush_handle:
+            self._flush_handle = loop.call_later(BATCH_DELAY_SECONDS, self._flush)
+        for steam_id, future in futures.items():
+            summaries[steam_id] = await future
+        return summaries
+
+    async def get_avatar_urls_async(self, steam_ids: Iterable[str]) -> Dict[str, str]:
+        summaries = await self.get_summaries_async(steam_ids)
+        return {
+            steam_id: summary["avatarfull"]
+            for steam_id, summary in summaries.items()
+            if summary
+        }
+
+
+steam_profiles = SteamProfileService()
 
 
 def get_steam_user_summary(steam_id: str):
-    url = f"http://api.steampowered.com/ISteamUser/GetPlayerSummaries/v0002/?key={STEAM_API_KEY}&steamids={steam_id}"
-    response = requests.get(url)
-    if response.status_code == 200:
-        return response.json()["response"]["players"][0]
+    return steam_profiles.get_summaries([steam_id]).get(steam_id)
 
 
 def get_steam_user_avatar_url(steam_id: str):
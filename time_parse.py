@@ -1,5 +1,12 @@
 import re
 from datetime import datetime
+from functools import lru_cache
+from typing import Iterable, List
+
+import numpy as np
+
+DATETIME_FORMAT = r"%d/%m/%Y %H:%M"
+LAP_TIME_PATTERN = re.compile(r"(\d+):(\d{2})\.(\d{3})")
 
 
 def parse_datetime(s: str) -> datetime:
@@ -12,23 +19,131 @@ def parse_datetime(s: str) -> datetime:
     Returns:
     datetime: parsed datetime
     """
-    DATETIME_FORMAT = r"%d/%m/%Y %H:%M"
-
     return datetime.strptime(s, DATETIME_FORMAT)
 
 
 def parse_lap_time(s: str) -> int:
     """
     Parses lap time in milliseconds from string
-    
+
     Parameters:
     s (str): lap time string with formatting: <MM:SS.mmm>
 
     Returns:
     int: total milliseconds of lap time
     """
-    LAP_TIME_PATTERN = r"(\d+):(\d{2})\.(\d{3})"
-
-    matches = re.fullmatch(LAP_TIME_PATTERN, s).groups()
-    minutes, seconds, millis = tuple(map(int, matches))
+    match = LAP_TIME_PATTERN.fullmatch(s)
+    if not match:
+        raise ValueError(f"invalid lap time '{s}'")
+    minutes, seconds, millis = map(int, match.groups())
     return (minutes * 60 + seconds) * 1000 + millis
+
+
+def _char_matrix(strings: List[str]) -> np.ndarray:
+    """
+    Returns ASCII strings of equal length as rows of a uint8 matrix, or None
+    if they are not
+    """
+    length = len(strings[0])
+    joined = "".join(strings)
+    if len(joined) != length * len(strings) or not joined.isascii():
+        return None
+    if any(len(s) != length for s in strings):
+        return None
+    return np.frombuffer(joined.encode("ascii"), dtype=np.uint8).reshape(
+        len(strings), length
+    )
+
+
+def _digits(chars: np.ndarray, separators: dict) -> np.ndarray:
+    """
+    Returns the digit columns of a character matrix as int64, or None if a
+    separator column holds another character or any other column a non-digit
+    """
+    for column, separator in separators.items():
+        if (chars[:, column] != ord(separator)).any():
+            return None
+    columns = [i for i in range(chars.shape[1]) if i not in separators]
+    digits = chars[:, columns].astype(np.int64) - ord("0")
+    if ((digits < 0) | (digits > 9)).any():
+        return None
+    return digits
+
+
+@lru_cache(maxsize=8)
+def _lap_time_weights(length: int) -> np.ndarray:
+    # milliseconds of each digit of MM:SS.mmm, minutes can have more digits
+    minutes = [60000 * 10 ** i for i in reversed(range(length - 7))]
+    return np.array(minutes + [10000, 1000, 100, 10, 1], dtype=np.int64)
+
+
+def parse_lap_times(strings: Iterable[str]) -> List[int]:
+    """
+    Parses all lap time strings of a page at once, see parse_lap_time
+
+    Strings of equal length are read at fixed offsets as a single character
+    matrix; anything else is parsed one by one.
+    """
+    strings = list(strings)
+    if not strings:
+        return []
+    length = len(strings[0])
+    chars = _char_matrix(strings) if length >= 8 else None
+    if chars is not None:
+        digits = _digits(chars, {length - 7: ":", length - 4: "."})
+        if digits is not None:
+            return (digits @ _lap_time_weights(length)).tolist()
+    return [parse_lap_time(s) for s in strings]
+
+
+def _parse_datetimes(strings: List[str]) -> List[datetime]:
+    """
+    Returns None unless all strings are well-formed dates
+    """
+    chars = _char_matrix(strings) if len(strings[0]) == 16 else None
+    if chars is None:
+        return None
+    # dd/mm/YYYY HH:MM
+    digits = _digits(chars, {2: "/", 5: "/", 10: " ", 13: ":"})
+    if digits is None:
+        return None
+    day, month, year, hour, minute = (
+        digits[:, columns] @ (10 ** np.arange(len(columns)))[::-1]
+        for columns in ([0, 1], [2, 3], [4, 5, 6, 7], [8, 9], [10, 11])
+    )
+    if (
+        (year < 1).any()
+        or ((month < 1) | (month > 12)).any()
+        or (day < 1).any()
+        or (hour > 23).any()
+        or (minute > 59).any()
+    ):
+        return None
+    months = (12 * (year - 1970) + month - 1).astype("datetime64[M]")
+    days = months.astype("datetime64[D]") + (day - 1)
+    # days past the end of a month roll over into the next one
+    if (days.astype("datetime64[M]") != months).any():
+        return None
+    minutes = days.astype("datetime64[m]") + 60 * hour + minute
+    return minutes.tolist()
+
+
+def parse_datetimes(strings: Iterable[str]) -> List[datetime]:
+    """
+    Parses all upload date strings of a page at once, see parse_datetime
+
+    Every distinct string is parsed once, many rows share an upload minute.
+    Well-formed strings are read at fixed offsets as a single character
+    matrix; otherwise each distinct string goes through strptime.
+    """
+    strings = list(strings)
+    if not strings:
+        return []
+    distinct = list(dict.fromkeys(strings))
+    parsed = _parse_datetimes(distinct)
+    if parsed is None:
+        parsed = [parse_datetime(s) for s in distinct]
+    if len(distinct) == len(strings):
+        return parsed
+    parsed = dict(zip(distinct, parsed))
+    return [parsed[s] for s in strings]
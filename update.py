@@ -1,81 +1,345 @@
 import asyncio
 from datetime import datetime
+from typing import Iterable, List, Tuple
 
-import aiohttp
-from sqlalchemy import func, or_
+from sqlalchemy import case, exists, func, or_, select, update
 
 import db
-from events import update_session_end_event, update_session_start_event
-from models import LapRecord, Subscription
-from scrape import scrape_lap_records
+import job_queue
+from crawler import CrawlScheduler, create_http_session
+from discord_dispatcher import DiscordDispatcher
+from events import (
+    all_events,
+    drain_events,
+    update_session_end_event,
+    update_session_start_event,
+)
+from logger import logger
+from metrics import profiled, run_metrics
+from models import LapRecord, Player, Subscription, update_subscriptions
+from page_cache import PageCache
+from scheduling import rebalance_intervals
+from scrape import create_parse_executor, scrape_lap_records
 from settings import (
+    CRAWL_BURST,
+    CRAWL_MAX_CONCURRENCY,
+    CRAWL_MAX_PER_HOST,
+    CRAWL_QUEUE_SIZE,
+    CRAWL_REQUESTS_PER_SECOND,
+    DISCORD_WEBHOOK,
     HIGH_UPDATE_INTERVAL,
     LOW_UPDATE_INTERVAL,
     LOW_UPDATE_THRESHOLD,
     MID_UPDATE_INTERVAL,
+    PAGE_CACHE_PATH,
+    PERSIST_BATCH_SIZE,
+    UPDATE_JOB_LEASE_SECONDS,
+    UPDATE_REQUESTS_PER_HOUR,
 )
 
 
-def update_intervals():
-    # set update_interval_hours to subscriptions with tracked players
-    subscriptions_to_update = (
-        db.session.query(Subscription)
-        .select_from(LapRecord)
-        .join(Subscription)
-        .filter(Subscription.update_interval_hours != None)
-        .filter(Subscription.update_interval_hours != HIGH_UPDATE_INTERVAL)
-        .filter(LapRecord.player.has())
-        .all()
+def _subset(statement, subscription_ids):
+    if subscription_ids is None:
+        return statement
+    return statement.where(Subscription.id.in_(subscription_ids))
+
+
+def _update_intervals(subscription_ids: List[int] = None):
+    active = Subscription.update_interval_hours != None
+    # IN instead of a join lets SQLite walk the player_id index from the few
+    # tracked players rather than scanning all lap records
+    tracked = (
+        select(LapRecord.subscription_id)
+        .where(LapRecord.player_id.in_(select(Player.steam_id)))
+        .distinct()
+    )
+    if subscription_ids is not None:
+        tracked = tracked.where(LapRecord.subscription_id.in_(subscription_ids))
+    db.session.execute(
+        _subset(update(Subscription), subscription_ids)
+        .where(active)
+        .where(Subscription.update_interval_hours != HIGH_UPDATE_INTERVAL)
+        .where(Subscription.id.in_(tracked))
+        .values(update_interval_hours=HIGH_UPDATE_INTERVAL),
+        execution_options={"synchronize_session": False},
     )
-    for s in subscriptions_to_update:
-        s.update_interval_hours = HIGH_UPDATE_INTERVAL
 
-    # check & set update_interval_hours to subscriptions without tracked players
-    subscriptions_to_update = (
-        db.session.query(Subscription, func.count(Subscription.lap_records))
-        .select_from(Subscription)
-        .join(LapRecord)
-        .all()
+    untracked = active & Subscription.id.not_in(tracked)
+    if UPDATE_REQUESTS_PER_HOUR:
+        untracked &= Subscription.change_rate == None
+    counts = select(
+        LapRecord.subscription_id, func.count().label("records_count")
+    ).group_by(LapRecord.subscription_id)
+    if subscription_ids is not None:
+        counts = counts.where(LapRecord.subscription_id.in_(subscription_ids))
+    counts = counts.subquery()
+    interval = case(
+        (counts.c.records_count > LOW_UPDATE_THRESHOLD, MID_UPDATE_INTERVAL),
+        else_=LOW_UPDATE_INTERVAL,
+    )
+    db.session.execute(
+        _subset(update(Subscription), subscription_ids)
+        .where(Subscription.id == counts.c.subscription_id)
+        .where(untracked)
+        .where(Subscription.update_interval_hours != interval)
+        .values(update_interval_hours=interval),
+        execution_options={"synchronize_session": False},
     )
-    for s, lap_records_count in subscriptions_to_update:
-        if lap_records_count < LOW_UPDATE_THRESHOLD:
-            if s.update_interval_hours != LOW_UPDATE_INTERVAL:
-                s.update_interval_hours = LOW_UPDATE_INTERVAL
-        else:
-            if s.update_interval_hours != MID_UPDATE_INTERVAL:
-                s.update_interval_hours = MID_UPDATE_INTERVAL
+    db.session.execute(
+        _subset(update(Subscription), subscription_ids)
+        .where(untracked)
+        .where(Subscription.update_interval_hours != LOW_UPDATE_INTERVAL)
+        .where(~exists().where(LapRecord.subscription_id == Subscription.id))
+        .values(update_interval_hours=LOW_UPDATE_INTERVAL),
+        execution_options={"synchronize_session": False},
+    )
+
+
+def update_intervals(subscription_ids: Iterable[int] = None):
+    """
+    Recomputes update_interval_hours of active subscriptions with set based
+    UPDATE statements, the same way as Subscription.refresh_update_interval;
+    subscription_ids limits it to a subset
 
+    With adaptive scheduling only tracked players are enforced on
+    subscriptions with a learned change rate, see scheduling.py
+    """
+    if subscription_ids is not None:
+        subscription_ids = list(subscription_ids)
+        # stays below the bound parameter limit of SQLite
+        for i in range(0, len(subscription_ids), 10000):
+            _update_intervals(subscription_ids[i : i + 10000])
+    else:
+        _update_intervals(None)
     db.session.commit()
     return True
 
 
-async def async_update_records(limit: int = -1, forced: bool = False):
-    # limit == -1 means no limit
-    now = datetime.utcnow()
-    subscriptions_to_update = (
-        db.session.query(Subscription)
-        .filter(Subscription.update_interval_hours != None)
-        .filter(
+def _persist_batch(batch: list, cache: PageCache = None, owner: str = None):
+    try:
+        if owner:
+            # jobs are done in the same transaction as their records
+            job_queue.complete(owner, [s.id for s, _ in batch])
+        update_subscriptions(batch)
+    except Exception as e:
+        db.session.rollback()
+        if len(batch) == 1:
+            s = batch[0][0]
+            logger.exception(f"Failed to persist records of {s}")
+            if cache:
+                cache.discard(s.track_id, s.vehicle_id)
+            if owner:
+                job_queue.fail(owner, s.id, repr(e))
+            return
+        # isolate the failing subscription by retrying one at a time
+        for item in batch:
+            _persist_batch([item], cache, owner)
+        return
+    if cache:
+        for s, _ in batch:
+            cache.commit(s.track_id, s.vehicle_id)
+
+
+async def _persist_results(
+    results: asyncio.Queue, cache: PageCache = None, owner: str = None
+):
+    """
+    DB writer stage: updates subscriptions as soon as their scrape results
+    arrive, committing whatever is already queued in one transaction, until
+    a None sentinel is received
+    """
+    finished = False
+    while not finished:
+        run_metrics.set_gauge("results_queue_depth", results.qsize())
+        batch = [await results.get()]
+        while len(batch) < PERSIST_BATCH_SIZE and not results.empty():
+            batch.append(results.get_nowait())
+        if None in batch:
+            batch.remove(None)
+            finished = True
+        if batch:
+            run_metrics.observe("persist_batch_size", len(batch))
+            _persist_batch(batch, cache, owner)
+
+
+async def _renew_leases(owner: str):
+    """
+    Keeps the update jobs of a live run leased; a run that dies stops
+    renewing and its jobs can be claimed again once the lease expires
+    """
+    while True:
+        await asyncio.sleep(UPDATE_JOB_LEASE_SECONDS / 3)
+        try:
+            job_queue.renew_leases(owner)
+        except Exception:
+            # e.g. locked by another shard, the next renewal is still in time
+            db.session.rollback()
+            logger.exception("Failed to renew update job leases")
+
+
+def due_subscriptions_query(
+    now: datetime, forced: bool = False, shard: Tuple[int, int] = None
+):
+    # forced also selects subscriptions not due yet
+    query = db.session.query(Subscription).filter(
+        Subscription.update_interval_hours != None
+    )
+    if shard:
+        index, count = shard
+        query = query.filter(Subscription.id % count == index)
+    if not forced:
+        query = query.filter(
             or_(
                 Subscription.last_update == None,
                 Subscription.next_update <= now,
             )
         )
-        .order_by(Subscription.next_update)
-        .limit(limit)
+    return query.order_by(Subscription.next_update)
+
+
+def create_shard_scheduler(shard: Tuple[int, int] = None) -> CrawlScheduler:
+    """
+    Returns crawl scheduler of a shard, holding its share of the configured
+    concurrency and request rate so all shards together stay within them
+    """
+    if not shard:
+        return CrawlScheduler()
+    _, count = shard
+    return CrawlScheduler(
+        max_concurrency=max(1, CRAWL_MAX_CONCURRENCY // count),
+        max_per_host=max(1, CRAWL_MAX_PER_HOST // count),
+        requests_per_second=CRAWL_REQUESTS_PER_SECOND / count,
+        burst=max(1, CRAWL_BURST // count),
     )
-    async with aiohttp.ClientSession(raise_for_status=True) as client:
-        tasks = [
-            scrape_lap_records(client, s.track_id, s.vehicle_id)
-            for s in subscriptions_to_update
-        ]
-        results = await asyncio.gather(*tasks)
-    for s, lap_records in zip(subscriptions_to_update, results):
-        s.update(lap_records, forced=forced)
-
-
-def update_records(limit: int = -1, forced: bool = False):
-    asyncio.run(async_update_records(limit, forced))
+
+
+async def async_update_records(
+    limit: int = -1, forced: bool = False, shard: Tuple[int, int] = None
+):
+    """
+    Scrapes and persists due subscriptions; shard (index, count) restricts
+    the run to subscriptions with id % count == index, see
+    main.update_records_parallel. Rebalancing intervals and Discord delivery
+    are left to the caller of sharded runs.
+
+    Due subscriptions are queued as update jobs first and the run leases up
+    to limit of them, see job_queue.py. Jobs of an interrupted run are
+    picked up again by the next one, failed ones are retried with backoff.
+    """
+    # limit == -1 means no limit
+    update_session_start_event.publish()
+    now = datetime.utcnow()
+    if forced:
+        # forced runs bypass the queue, their jobs would jump ahead of due ones
+        owner = None
+        subscriptions_to_update = (
+            due_subscriptions_query(now, forced, shard).limit(limit).all()
+        )
+    else:
+        owner = job_queue.new_owner()
+        run_metrics.inc(
+            "update_jobs_enqueued",
+            job_queue.enqueue(due_subscriptions_query(now, shard=shard), now),
+        )
+        run_metrics.inc(
+            "update_jobs_claimed", job_queue.claim(owner, limit, now, shard)
+        )
+        subscriptions_to_update = job_queue.claimed_subscriptions_query(owner).all()
+
+    scheduler = create_shard_scheduler(shard)
+    for s in subscriptions_to_update:
+        scheduler.schedule(s, now)
+    run_metrics.set_gauge("subscriptions_due", len(scheduler))
+
+    # forced updates bypass the page cache to re-read every page
+    cache = PageCache() if PAGE_CACHE_PATH and not forced else None
+    # scraped subscriptions are persisted as they finish; the bounded queue
+    # makes scrapers wait for the writer instead of piling up results
+    results = asyncio.Queue(maxsize=CRAWL_QUEUE_SIZE)
+    writer = asyncio.ensure_future(_persist_results(results, cache, owner))
+    lease_keeper = asyncio.ensure_future(_renew_leases(owner)) if owner else None
+    executor = create_parse_executor()
+    # notifications queued by record events are sent in the background
+    dispatcher = DiscordDispatcher() if DISCORD_WEBHOOK and not shard else None
+    if dispatcher:
+        dispatcher.start()
+
+    async def scrape_subscription(s: Subscription):
+        run_metrics.set_gauge("crawl_queue_depth", len(scheduler))
+        try:
+            lap_records = await scrape_lap_records(
+                client,
+                s.track_id,
+                s.vehicle_id,
+                scheduler,
+                since=None if forced else s.last_update,
+                executor=executor,
+                # records of a subscription never saved are not in the database
+                cache=cache if s.last_update else None,
+            )
+        except Exception as e:
+            # keep the subscription due, its job is retried after a backoff
+            logger.exception(f"Failed to scrape records of {s}")
+            run_metrics.inc("subscriptions_failed")
+            if cache:
+                cache.discard(s.track_id, s.vehicle_id)
+            if owner:
+                job_queue.fail(owner, s.id, repr(e))
+            return
+        run_metrics.set_gauge("results_queue_depth", results.qsize())
+        await results.put((s, lap_records))
+
+    crawl = None
+    try:
+        async with create_http_session() as client:
+            crawl = asyncio.ensure_future(scheduler.run(scrape_subscription))
+            # a dead writer would leave scrapers waiting on the full queue
+            await asyncio.wait({crawl, writer}, return_when=asyncio.FIRST_COMPLETED)
+            if writer.done():
+                crawl.cancel()
+                writer.result()
+                raise RuntimeError("DB writer stopped before the crawl finished")
+            crawl.result()
+        await results.put(None)
+        await writer
+        if UPDATE_REQUESTS_PER_HOUR and not shard:
+            rebalance_intervals()
+        await drain_events()
+        for event in all_events:
+            logger.debug(f"Event metrics: {event.metrics()}")
+        if dispatcher:
+            await dispatcher.stop()
+    finally:
+        # a failed run stops renewing, its jobs are released below
+        if lease_keeper:
+            lease_keeper.cancel()
+        if crawl:
+            crawl.cancel()
+        writer.cancel()
+        # jobs not finished by an interrupted run go back to the queue
+        try:
+            db.session.rollback()
+            if owner:
+                job_queue.release(owner)
+            job_queue.purge()
+        except Exception:
+            logger.exception("Failed to release update jobs")
+        if executor:
+            executor.shutdown()
+        if cache:
+            run_metrics.inc("page_cache_hits", cache.hits)
+            run_metrics.inc("page_cache_misses", cache.misses)
+            # one shard evicts for all of them
+            cache.close(evict=not shard or shard[0] == 0)
+        update_session_end_event.publish()
+
+
+def update_records(
+    limit: int = -1, forced: bool = False, shard: Tuple[int, int] = None
+):
+    # PROFILER set to "cprofile" or "pyinstrument" profiles the whole run
+    with profiled():
+        asyncio.run(async_update_records(limit, forced, shard))
 
 
 def update_high_interval_only(limit: int = -1, forced: bool = False):
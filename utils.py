@@ -1,2 +0,0 @@
-def flatten_list(l: list):
-    return [item for sublist in l for item in sublist]
@@ -1,70 +1,193 @@
-from sqlalchemy import func
+from typing import Sequence
+
+from sqlalchemy import and_, func
 
 from db import session
-from models import LapRecord, Player, Subscription, Track, Vehicle
+from models import (
+    LapRecord,
+    Player,
+    Subscription,
+    SubscriptionBest,
+    Track,
+    TrackClassBest,
+    Vehicle,
+)
+
+# leaderboard columns top records can be grouped by
+GROUP_COLUMNS = {
+    "track": Subscription.track_id,
+    "class": Vehicle.class_id,
+    "vehicle": Subscription.vehicle_id,
+    "controller": LapRecord.controller_id,
+    "player": LapRecord.player_id,
+}
 
 
 def get_all_tracked_records():
-    subquery = (
-        session.query(
-            Subscription.id.label("subscription_id"),
-            func.min(LapRecord.lap_time).label("min_lap_time"),
-        )
-        .select_from(LapRecord)
-        .join(Subscription)
-        .group_by(Subscription.id)
-        .subquery("subquery")
-    )
     query = (
         session.query(
             LapRecord.upload_date,
             Player.name,
             Track.name,
             Vehicle.name,
-            Vehicle.class_,
+            Vehicle.class_id,
             LapRecord.lap_time,
-            LapRecord.lap_time - subquery.c.min_lap_time,
+            LapRecord.lap_time - SubscriptionBest.lap_time,
         )
         .select_from(LapRecord)
-        .join(Player, Subscription, Track, Vehicle)
-        .filter(Subscription.id == subquery.c.subscription_id)
+        .join(Player)
+        .join(Subscription)
+        .join(Track)
+        .join(Vehicle)
+        .join(
+            SubscriptionBest,
+            SubscriptionBest.subscription_id == LapRecord.subscription_id,
+        )
         .order_by(LapRecord.upload_date)
     )
     return query.all()
 
 
-def get_top_tracked_per_track_and_class():
-    subquery = (
+def _group_best_subquery(group_by: Sequence[str]):
+    """
+    Returns subquery of the fastest lap time per group, read from the
+    materialized track and class table when possible
+    """
+    if sorted(group_by) == ["class", "track"]:
+        return session.query(
+            TrackClassBest.track_id.label("group_track"),
+            TrackClassBest.class_id.label("group_class"),
+            TrackClassBest.lap_time.label("best_lap_time"),
+        ).subquery("best")
+    partition = [GROUP_COLUMNS[name] for name in group_by]
+    return (
         session.query(
-            Track.id.label("track_id"),
-            Vehicle.class_.label("vehicle_class"),
-            func.min(LapRecord.lap_time).label("min_lap_time"),
+            *(
+                column.label(f"group_{name}")
+                for name, column in zip(group_by, partition)
+            ),
+            func.min(LapRecord.lap_time).label("best_lap_time"),
         )
         .select_from(LapRecord)
-        .join(Subscription, Track, Vehicle)
-        .group_by(Track.id, Vehicle.class_)
-        .subquery("subquery")
+        .join(Subscription)
+        .join(Vehicle)
+        .group_by(*partition)
+        .subquery("best")
     )
+
+
+def get_top_records(
+    group_by: Sequence[str] = ("track", "class"),
+    n: int = 1,
+    tracked_only: bool = True,
+):
+    """
+    Returns the n fastest records per group with their gap to the fastest
+    record of the group
+
+    Parameters:
+    group_by (Sequence[str]): keys of GROUP_COLUMNS to partition records by
+    n (int): number of records per group
+    tracked_only (bool): rank only records of tracked players; gaps are
+    still measured to the fastest record of any player
+
+    Returns:
+    list: rows of track, class, vehicle, controller, player name, upload
+    date, lap time, gap and position, ordered by group and position
+    """
+    try:
+        partition = [GROUP_COLUMNS[name] for name in group_by]
+    except KeyError as e:
+        raise ValueError(f"unknown group column {e}")
+    columns = [
+        LapRecord.subscription_id,
+        LapRecord.controller_id,
+        LapRecord.upload_date,
+        LapRecord.lap_time,
+        func.row_number()
+        .over(
+            partition_by=partition,
+            order_by=(LapRecord.lap_time, LapRecord.upload_date),
+        )
+        .label("position"),
+        *(
+            column.label(f"group_{name}")
+            for name, column in zip(group_by, partition)
+        ),
+    ]
+    if tracked_only:
+        # only tracked records are ranked, the group best comes separately
+        ranked = (
+            session.query(Player.name.label("player_name"), *columns)
+            .select_from(LapRecord)
+            .join(Player)
+            .join(Subscription)
+            .join(Vehicle)
+        ).subquery("ranked")
+        best = _group_best_subquery(group_by)
+        gap = ranked.c.lap_time - best.c.best_lap_time
+    else:
+        gap_column = (
+            LapRecord.lap_time
+            - func.min(LapRecord.lap_time).over(partition_by=partition)
+        ).label("gap")
+        ranked = (
+            session.query(
+                func.coalesce(Player.name, LapRecord.player_name).label(
+                    "player_name"
+                ),
+                gap_column,
+                *columns,
+            )
+            .select_from(LapRecord)
+            .join(Subscription)
+            .join(Vehicle)
+            .outerjoin(Player)
+        ).subquery("ranked")
+        gap = ranked.c.gap
+
     query = (
         session.query(
             Track.name,
-            Vehicle.class_,
-            Player.name,
+            Vehicle.class_id,
             Vehicle.name,
-            LapRecord.upload_date,
-            LapRecord.lap_time,
-            LapRecord.lap_time - subquery.c.min_lap_time,
+            ranked.c.controller_id,
+            ranked.c.player_name,
+            ranked.c.upload_date,
+            ranked.c.lap_time,
+            gap,
+            ranked.c.position,
         )
-        .select_from(LapRecord)
-        .join(Player, Subscription, Track, Vehicle)
-        .filter(
-            Track.id == subquery.c.track_id,
-            Vehicle.class_ == subquery.c.vehicle_class,
+        .select_from(ranked)
+        .join(Subscription, Subscription.id == ranked.c.subscription_id)
+        .join(Track, Track.id == Subscription.track_id)
+        .join(Vehicle, Vehicle.id == Subscription.vehicle_id)
+        .filter(ranked.c.position <= n)
+    )
+    if tracked_only:
+        query = query.join(
+            best,
+            and_(
+                *(
+                    best.c[f"group_{name}"] == ranked.c[f"group_{name}"]
+                    for name in group_by
+                )
+            ),
         )
-        .group_by(Track.id, Vehicle.class_)
+    query = query.order_by(
+        *(ranked.c[f"group_{name}"] for name in group_by), ranked.c.position
     )
     return query.all()
 
 
+def get_top_tracked_per_track_and_class():
+    return [
+        (track, class_, player, vehicle, upload_date, lap_time, gap)
+        for track, class_, vehicle, _, player, upload_date, lap_time, gap, _ in (
+            get_top_records(("track", "class"), n=1, tracked_only=True)
+        )
+    ]
+
+
 if __name__ == "__main__":
     print(get_top_tracked_per_track_and_class())